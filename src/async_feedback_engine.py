@@ -0,0 +1,150 @@
+import os
+import math
+import time
+import asyncio
+import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
+from logger_config import logger
+from utils.helpers import build_feedback_prompt, GEMINI_MODEL, GEMINI_API_ENDPOINT
+from feedback_journal import feedback_journal
+from response_cache import response_cache
+from rate_limiter import get_rate_limiter
+from gemini_client import get_model, generate_content_async
+from retry_policy import classify_error, retry_policy
+from service_account_processor import sa_processor, collect_feedback_tasks, fallback_comment
+
+# Thời gian phản hồi trung bình ước tính của Gemini, dùng để tính số request chạy song song
+FEEDBACK_LATENCY_SECONDS = float(os.getenv("FEEDBACK_LATENCY_SECONDS", 8))
+MAX_IN_FLIGHT = int(os.getenv("FEEDBACK_MAX_IN_FLIGHT", 500))
+
+
+def in_flight_limit(rate_limiter):
+    """Số request đồng thời đủ để dùng hết quota: tốc độ cho phép × thời gian phản hồi"""
+    return max(1, min(MAX_IN_FLIGHT, math.ceil(rate_limiter.rate * FEEDBACK_LATENCY_SECONDS) + 1))
+
+
+async def generate_feedback_async_task(model, task_args, semaphore, rate_limiter, max_attempts=10):
+    """
+    Tạo nhận xét cho một học sinh bằng client async của Gemini
+
+    Returns:
+        tuple: (student_name, nhận xét, True nếu là nhận xét dự phòng)
+    """
+    student_name = task_args[0]
+    prompt = build_feedback_prompt(task_args)
+
+    cached_comment = response_cache.get(GEMINI_MODEL, prompt)
+    if cached_comment is not None:
+        return (student_name, cached_comment, False)
+
+    backoff_delay = 0.0
+    async with semaphore:
+        for attempt in range(max_attempts):
+            # Chờ đến lượt theo token bucket (không chặn event loop)
+            wait = rate_limiter.acquire()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            try:
+                response = await generate_content_async(model, prompt)
+                gemini_comment = response.text
+                response_cache.put(GEMINI_MODEL, prompt, gemini_comment)
+                return (student_name, gemini_comment, False)
+
+            except Exception as e:
+                info = classify_error(e)
+                backoff_delay = retry_policy.next_delay(backoff_delay, info.retry_delay)
+
+                if info.is_rate_limit:
+                    logger.warning(f"⚠️ Rate limit cho {student_name} (lần {attempt + 1}/{max_attempts}, {retry_policy.describe(info, backoff_delay)})")
+                    rate_limiter.penalize(backoff_delay)
+                else:
+                    logger.error(f"❌ Lỗi Gemini cho {student_name} (lần {attempt + 1}/{max_attempts}, {retry_policy.describe(info, backoff_delay)}): {str(e)[:100]}...")
+                    await asyncio.sleep(backoff_delay)
+
+    logger.warning(f"⚠️ Dùng nhận xét dự phòng cho {student_name} sau {max_attempts} lần thử.")
+    return (student_name, fallback_comment(task_args), True)
+
+
+async def generate_feedbacks_async(tasks, on_result=None):
+    """
+    Tạo nhận xét cho danh sách học sinh trong một tiến trình, nhiều request cùng lúc
+
+    Args:
+        tasks (list): Danh sách (index, task_args)
+        on_result (callable, optional): Gọi on_result(index, task_args, nhận xét, is_fallback) ngay khi có kết quả
+
+    Returns:
+        dict: {index: nhận xét}
+    """
+    if sa_processor.service_account_creds is not None:
+        model = get_model("service_account", sa_processor.service_account_creds)
+    else:
+        model = genai.GenerativeModel(GEMINI_MODEL)
+
+    rate_limiter = get_rate_limiter()
+    semaphore = asyncio.Semaphore(in_flight_limit(rate_limiter))
+    if GEMINI_API_ENDPOINT:
+        # Request REST chạy trong thread pool: đủ thread cho số request đồng thời
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=in_flight_limit(rate_limiter)))
+
+    async def run(index, task_args):
+        try:
+            result = await generate_feedback_async_task(model, task_args, semaphore, rate_limiter)
+        except Exception as e:
+            logger.error(f"❌ Lỗi khi xử lý nhận xét cho {task_args[0]}: {e}")
+            result = (task_args[0], fallback_comment(task_args), True)
+        return index, task_args, result
+
+    comments = {}
+    for next_result in asyncio.as_completed([run(index, task_args) for index, task_args in tasks]):
+        index, task_args, (student_name, comment, is_fallback) = await next_result
+        comments[index] = comment
+        if on_result is not None:
+            on_result(index, task_args, comment, is_fallback)
+
+    return comments
+
+
+def process_feedbacks_async(new_df, sheet_name="", resume=False):
+    """
+    Tạo nhận xét cho sheet bằng engine asyncio (một tiến trình, số request đồng thời theo rate limit).
+    Mỗi nhận xét được ghi vào nhật ký ngay khi nhận được (trừ nhận xét dự phòng)
+
+    Args:
+        new_df (DataFrame): Kết quả chấm điểm của sheet
+        sheet_name (str): Tên sheet (khóa trong nhật ký nhận xét)
+        resume (bool): Bỏ qua các học sinh đã có nhận xét trong nhật ký
+    """
+    if "Nhận xét" not in new_df.columns:
+        new_df["Nhận xét"] = ""
+
+    tasks = collect_feedback_tasks(new_df)
+    if resume:
+        tasks, saved_comments = feedback_journal.split_completed(sheet_name, tasks)
+        for index, comment in saved_comments.items():
+            new_df.at[index, "Nhận xét"] = comment
+
+    if not tasks:
+        return new_df
+
+    rate_limiter = get_rate_limiter()
+    logger.info(f"⚡ Tạo nhận xét async cho {len(tasks)} học sinh, tối đa {in_flight_limit(rate_limiter)} request đồng thời ({rate_limiter.requests_per_minute} req/phút)")
+
+    stats = {"completed": 0, "fallback": 0}
+    start_time = time.time()
+
+    def on_result(index, task_args, comment, is_fallback):
+        new_df.at[index, "Nhận xét"] = comment
+        if is_fallback:
+            stats["fallback"] += 1
+        else:
+            feedback_journal.record(sheet_name, index, task_args, comment)
+        stats["completed"] += 1
+        if stats["completed"] % 20 == 0:
+            logger.info(f"📈 Đã hoàn thành {stats['completed']}/{len(tasks)} nhận xét... {rate_limiter.get_stats()}")
+
+    asyncio.run(generate_feedbacks_async(tasks, on_result=on_result))
+
+    logger.info(f"🎯 Hoàn thành {stats['completed']} nhận xét trong {time.time() - start_time:.1f}s ({stats['fallback']} dự phòng)")
+    return new_df
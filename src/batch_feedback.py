@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import numpy as np
+from logger_config import logger
+from utils.helpers import load_prompt, BATCH_PROMPT_FILE, GEMINI_MODEL
+from response_cache import response_cache
+from rate_limiter import get_rate_limiter
+from gemini_client import get_model
+from retry_policy import classify_error, retry_policy
+from service_account_processor import sa_processor
+
+# Số học sinh tối đa trong một request và ngân sách token (ước lượng ~4 ký tự/token)
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", 1))
+BATCH_INPUT_TOKEN_BUDGET = int(os.getenv("FEEDBACK_BATCH_INPUT_TOKENS", 6000))
+BATCH_OUTPUT_TOKEN_BUDGET = int(os.getenv("FEEDBACK_BATCH_OUTPUT_TOKENS", 8000))
+OUTPUT_TOKENS_PER_STUDENT = 400
+CHARS_PER_TOKEN = 4
+
+JSON_FENCE_PATTERN = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return ""
+    return value
+
+
+def student_payload(student_id, task_args):
+    """Dữ liệu của một học sinh trong prompt batch"""
+    (student_name, class_name, point, correct, wrong, skip, total_questions, correct_basic, correct_advanced,
+     percent_basic, percent_advanced, improvement_content) = task_args
+
+    payload = {
+        "id": student_id,
+        "ten": student_name,
+        "tong_so_cau": total_questions,
+        "diem": f"{_json_value(point)}/135",
+        "dung": correct,
+        "sai": wrong,
+        "bo_qua": skip,
+        "co_ban": correct_basic,
+        "phan_tram_co_ban": f"{_json_value(percent_basic)}%",
+        "nang_cao": correct_advanced,
+        "phan_tram_nang_cao": f"{_json_value(percent_advanced)}%",
+        "can_cai_thien": improvement_content,
+    }
+    return json.dumps({key: _json_value(value) for key, value in payload.items()}, ensure_ascii=False)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def chunk_tasks(tasks, batch_size=FEEDBACK_BATCH_SIZE, input_token_budget=BATCH_INPUT_TOKEN_BUDGET):
+    """
+    Chia danh sách (index, task_args) thành các batch: tối đa batch_size học sinh,
+    tổng token đầu vào và token đầu ra ước lượng không vượt ngân sách
+    """
+    max_students = max(1, min(batch_size, BATCH_OUTPUT_TOKEN_BUDGET // OUTPUT_TOKENS_PER_STUDENT))
+    base_tokens = estimate_tokens(load_prompt(file_path=BATCH_PROMPT_FILE, students=""))
+
+    batches = []
+    current = []
+    current_tokens = base_tokens
+    for index, task_args in tasks:
+        tokens = estimate_tokens(student_payload(str(index), task_args))
+        if current and (len(current) >= max_students or current_tokens + tokens > input_token_budget):
+            batches.append(current)
+            current = []
+            current_tokens = base_tokens
+        current.append((index, task_args))
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(batch):
+    """Tạo prompt cho một batch học sinh (mã học sinh là index trong DataFrame)"""
+    students = "\n".join(student_payload(str(index), task_args) for index, task_args in batch)
+    return load_prompt(file_path=BATCH_PROMPT_FILE, students=students)
+
+
+def parse_batch_response(text, expected_ids):
+    """
+    Tách phản hồi JSON thành nhận xét của từng học sinh
+
+    Returns:
+        dict: {mã học sinh: nhận xét}, chỉ gồm các học sinh có trong batch và có nhận xét hợp lệ
+    """
+    try:
+        data = json.loads(JSON_FENCE_PATTERN.sub("", text))
+    except (TypeError, ValueError) as e:
+        logger.warning(f"⚠️ Phản hồi batch không phải JSON hợp lệ: {e}")
+        return {}
+
+    if not isinstance(data, dict):
+        logger.warning("⚠️ Phản hồi batch không phải object JSON")
+        return {}
+
+    comments = {}
+    for student_id in expected_ids:
+        comment = data.get(student_id)
+        if isinstance(comment, str) and comment.strip():
+            comments[student_id] = comment.strip()
+    return comments
+
+
+def generate_feedback_batch(batch, max_attempts=5):
+    """
+    Tạo nhận xét cho một batch học sinh bằng một request Service Account
+
+    Args:
+        batch (list): Danh sách (index, task_args)
+
+    Returns:
+        dict: {index: nhận xét} cho các học sinh có trong phản hồi (học sinh thiếu cần thử lại riêng)
+    """
+    ids = {str(index): index for index, _ in batch}
+    prompt = build_batch_prompt(batch)
+    generation_config = {
+        "response_mime_type": "application/json",
+        "max_output_tokens": min(BATCH_OUTPUT_TOKEN_BUDGET, OUTPUT_TOKENS_PER_STUDENT * len(batch) + 200),
+    }
+
+    cached_response = response_cache.get(GEMINI_MODEL, prompt)
+    if cached_response is not None:
+        comments = parse_batch_response(cached_response, list(ids))
+        return {ids[student_id]: comment for student_id, comment in comments.items()}
+
+    if sa_processor.service_account_creds is None:
+        logger.error(f"❌ [Tiến trình {os.getpid()}] Thiếu thông tin Service Account")
+        return {}
+
+    backoff_delay = 0.0
+    for attempt in range(max_attempts):
+        try:
+            model = get_model("service_account", sa_processor.service_account_creds)
+            sa_processor.wait_for_request_slot()
+            response = model.generate_content(prompt, generation_config=generation_config)
+            response.resolve()
+
+            comments = parse_batch_response(response.text, list(ids))
+            if comments:
+                response_cache.put(GEMINI_MODEL, prompt, response.text)
+            logger.info(f"✅ [Tiến trình {os.getpid()}] Batch {len(batch)} học sinh: nhận được {len(comments)} nhận xét")
+            return {ids[student_id]: comment for student_id, comment in comments.items()}
+
+        except Exception as e:
+            info = classify_error(e)
+            backoff_delay = retry_policy.next_delay(backoff_delay, info.retry_delay)
+            if info.is_rate_limit:
+                logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Rate limit cho batch {len(batch)} học sinh ({retry_policy.describe(info, backoff_delay)})")
+                get_rate_limiter().penalize(backoff_delay)
+            else:
+                logger.error(f"❌ [Tiến trình {os.getpid()}] Lỗi batch (lần {attempt + 1}/{max_attempts}): {str(e)[:100]}...")
+                time.sleep(backoff_delay)
+
+    logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Batch {len(batch)} học sinh thất bại, sẽ thử lại từng học sinh")
+    return {}
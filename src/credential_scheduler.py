@@ -0,0 +1,170 @@
+import os
+import time
+import threading
+from collections import deque
+from multiprocessing.managers import BaseManager
+from logger_config import logger
+
+# Giới hạn của từng loại credential: (số request, cửa sổ thời gian tính bằng giây)
+API_KEY_LIMIT = (15, 600)          # 15 req/10 phút cho mỗi API key
+SERVICE_ACCOUNT_LIMIT = (60, 60)   # 60 req/phút cho Service Account
+DEFAULT_RETRY_DELAY = 60
+# Chỉ coi là hết credential khi credential sớm nhất cũng phải chờ quá lâu (lớn hơn cửa sổ 10 phút của API key),
+# tất cả đang bận (cửa sổ đầy) là trạng thái bình thường khi chạy hết công suất
+EXHAUSTED_WAIT_HORIZON = float(os.getenv("CREDENTIAL_EXHAUSTED_HORIZON", 900))
+
+
+class CredentialScheduler:
+    """
+    Điều phối API keys + Service Account cho mọi tiến trình: sliding window (deque) cho từng
+    credential, thời gian retry khi bị rate limit và danh sách key invalid.
+    Cấp key theo vòng (round-robin) để các tiến trình không dồn vào cùng một key.
+
+    Chạy trong một tiến trình riêng (start_credential_scheduler), các worker gọi qua proxy.
+    Credentials của Service Account không gửi qua IPC: worker nhận ("service_account", None)
+    và tự tạo credentials trong tiến trình của mình.
+    """
+
+    def __init__(self, api_keys, use_service_account=False):
+        self.api_keys = list(api_keys) if api_keys else []
+        self.use_service_account = use_service_account
+        self.invalid_keys = set()  # Keys bị lỗi 400
+        self.key_requests = {key: deque() for key in self.api_keys}  # Thời gian request trong cửa sổ của mỗi key
+        self.key_retry_until = {}  # Thời gian retry cho key bị rate limit
+        self.service_account_requests = deque()
+        self.service_account_retry_until = 0.0
+        self.next_key = 0  # Vị trí bắt đầu quét ở lần cấp key tiếp theo
+        self.using_service_account = False
+        self.leases = {"api_key": 0, "service_account": 0}
+        # Manager phục vụ mỗi kết nối trên một thread riêng
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _free_at(requests, limit, now):
+        """Thời điểm credential có thể nhận thêm request (bỏ các request đã ra khỏi cửa sổ)"""
+        max_requests, window = limit
+        while requests and requests[0] <= now - window:
+            requests.popleft()
+        if len(requests) < max_requests:
+            return now
+        return requests[0] + window
+
+    def _key_free_at(self, key, now):
+        return max(self._free_at(self.key_requests[key], API_KEY_LIMIT, now), self.key_retry_until.get(key, 0.0))
+
+    def _service_account_free_at(self, now):
+        return max(self._free_at(self.service_account_requests, SERVICE_ACCOUNT_LIMIT, now), self.service_account_retry_until)
+
+    def get_available_key(self):
+        """Cấp key khả dụng (ưu tiên API keys), chuyển sang Service Account khi hết key"""
+        with self.lock:
+            now = time.monotonic()
+            n_keys = len(self.api_keys)
+
+            for offset in range(n_keys):
+                position = (self.next_key + offset) % n_keys
+                key = self.api_keys[position]
+                if key in self.invalid_keys or self._key_free_at(key, now) > now:
+                    continue
+
+                self.key_requests[key].append(now)
+                self.next_key = (position + 1) % n_keys
+                self.leases["api_key"] += 1
+                return ("api_key", key)
+
+            if self.use_service_account and self._service_account_free_at(now) <= now:
+                self.service_account_requests.append(now)
+                self.leases["service_account"] += 1
+                if not self.using_service_account:
+                    self.using_service_account = True
+                    logger.warning("🔄 Chuyển sang sử dụng Service Account do hết API keys")
+                return ("service_account", None)
+
+            return None
+
+    def next_available_in(self):
+        """Số giây đến khi có credential khả dụng (None nếu không còn credential nào dùng được)"""
+        with self.lock:
+            now = time.monotonic()
+            free_times = [self._key_free_at(key, now) for key in self.api_keys if key not in self.invalid_keys]
+            if self.use_service_account:
+                free_times.append(self._service_account_free_at(now))
+            if not free_times:
+                return None
+            return max(0.0, min(free_times) - now)
+
+    def mark_key_invalid(self, key):
+        """Đánh dấu key bị lỗi 400 (expired/invalid)"""
+        with self.lock:
+            self.invalid_keys.add(key)
+            logger.warning(f"🚫 Key bị đánh dấu invalid: {key[:20]}...")
+
+    def mark_key_rate_limited(self, key_type, key_or_creds, retry_delay_seconds=None):
+        """Đánh dấu key hoặc Service Account bị rate limit"""
+        with self.lock:
+            delay = retry_delay_seconds or DEFAULT_RETRY_DELAY
+            retry_until = time.monotonic() + delay
+
+            if key_type == "api_key":
+                self.key_retry_until[key_or_creds] = retry_until
+                logger.warning(f"⏰ API Key bị rate limit, retry sau {delay}s: {key_or_creds[:20]}...")
+            elif key_type == "service_account":
+                self.service_account_retry_until = retry_until
+                logger.warning(f"⏰ Service Account bị rate limit, retry sau {delay}s")
+
+    def check_all_keys_exhausted(self, horizon=EXHAUSTED_WAIT_HORIZON):
+        """
+        Kiểm tra tất cả key có bị exhausted không (không tiêu tốn lượt request): không còn credential nào
+        dùng được, hoặc credential sớm nhất chỉ rảnh sau hơn horizon giây. Đang bận thì không tính là exhausted.
+        """
+        with self.lock:
+            wait = self.next_available_in()
+            if wait is None:
+                logger.warning("⚠️ Không còn API key hay Service Account nào dùng được")
+                return True
+            if wait > horizon:
+                logger.warning(f"⚠️ Credential sớm nhất chỉ rảnh sau {wait:.0f}s (quá {horizon:.0f}s)")
+                return True
+            return False
+
+    def get_stats(self):
+        """Lấy thống kê trạng thái keys"""
+        with self.lock:
+            now = time.monotonic()
+            total_keys = len(self.api_keys)
+            invalid_keys = len(self.invalid_keys)
+            rate_limited_keys = sum(1 for key in self.api_keys
+                                    if key not in self.invalid_keys and self.key_retry_until.get(key, 0.0) > now)
+            available_keys = sum(1 for key in self.api_keys
+                                 if key not in self.invalid_keys and self._key_free_at(key, now) <= now)
+
+            return {
+                'total_keys': total_keys,
+                'invalid_keys': invalid_keys,
+                'rate_limited_keys': rate_limited_keys,
+                'available_keys': available_keys,
+                'service_account_available': self.use_service_account and self._service_account_free_at(now) <= now,
+                'using_service_account': self.using_service_account,
+                'leases': dict(self.leases)
+            }
+
+
+class CredentialSchedulerManager(BaseManager):
+    """Tiến trình quản lý giữ CredentialScheduler dùng chung"""
+
+
+CredentialSchedulerManager.register("CredentialScheduler", CredentialScheduler)
+
+
+def start_credential_scheduler(api_keys, use_service_account=False):
+    """
+    Khởi động tiến trình điều phối credentials
+
+    Returns:
+        tuple: (manager, proxy). Truyền proxy cho worker qua initializer, gọi manager.shutdown() khi xong
+    """
+    manager = CredentialSchedulerManager()
+    manager.start()
+    scheduler = manager.CredentialScheduler(api_keys, use_service_account)
+    logger.info(f"🗂️ Đã khởi động tiến trình điều phối {len(api_keys)} API keys{' + Service Account' if use_service_account else ''}")
+    return manager, scheduler
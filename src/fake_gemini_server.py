@@ -0,0 +1,327 @@
+"""
+Server Gemini giả lập (generativelanguage REST) để đo tải offline, không tốn quota.
+
+Chạy server:
+    python src/fake_gemini_server.py --port 8765 --latency lognormal:0.7,0.5 --rate-limit 0.05 --key-rpm 15
+
+Trỏ pipeline sang server giả lập:
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8765 python src/main.py
+
+Thống kê (số request, mã lỗi, độ trễ p50/p95/p99) ở GET /stats, xóa thống kê bằng POST /reset.
+"""
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+GENERATE_PATH_PATTERN = re.compile(r"^/v1(?:beta)?/models/(?P<model>[^/:]+):generateContent$")
+STUDENT_ID_PATTERN = re.compile(r"\"id\":\s*\"([^\"]+)\"")
+STUDENT_NAME_PATTERN = re.compile(r"học sinh tên (.+?)\.\n")
+SERVICE_ACCOUNT_IDENTITY = "service_account"
+
+
+def parse_latency(spec):
+    """
+    Phân phối độ trễ (giây) từ chuỗi cấu hình:
+        "fixed:0.5", "uniform:0.2,1.5", "normal:0.8,0.2", "lognormal:0.7,0.5" (median, sigma)
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"Phân phối độ trễ không hợp lệ: {spec}")
+
+
+def error_body(code, status, message, details=()):
+    return {"error": {"code": code, "message": message, "status": status, "details": list(details)}}
+
+
+def rate_limit_body(retry_delay, quota_id, quota_metric):
+    return error_body(
+        429, "RESOURCE_EXHAUSTED",
+        f"You exceeded your current quota. Please retry in {retry_delay:.1f}s.",
+        [
+            {
+                "@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                "violations": [{"quotaMetric": quota_metric, "quotaId": quota_id}],
+            },
+            {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_delay:.3f}s"},
+        ],
+    )
+
+
+def invalid_key_body():
+    return error_body(
+        400, "INVALID_ARGUMENT", "API key expired. Please renew the API key.",
+        [{"@type": "type.googleapis.com/google.rpc.ErrorInfo", "reason": "API_KEY_INVALID", "domain": "googleapis.com"}],
+    )
+
+
+def internal_error_body():
+    return error_body(500, "INTERNAL", "An internal error has occurred. Please retry or report in https://developers.generativeai.google/guide/troubleshooting")
+
+
+def fake_comment(prompt):
+    """Nhận xét cố định theo prompt (cùng prompt thì cùng kết quả)"""
+    digest = sum(prompt.encode("utf-8")) % 1000
+    # Gọi tên học sinh như Gemini (kể cả tên giữ chỗ của request gộp nhóm)
+    name = STUDENT_NAME_PATTERN.search(prompt)
+    return f"Nhận xét giả lập #{digest}: {name.group(1) if name else 'thí sinh'} cần tiếp tục cố gắng ở các nội dung còn hạn chế."
+
+
+def fake_text(prompt, generation_config):
+    if generation_config.get("responseMimeType") == "application/json":
+        # Prompt batch: trả về object JSON theo id học sinh
+        return json.dumps({student_id: fake_comment(prompt + student_id) for student_id in STUDENT_ID_PATTERN.findall(prompt)},
+                          ensure_ascii=False)
+    return fake_comment(prompt)
+
+
+def success_body(model, text, prompt):
+    prompt_tokens = len(prompt) // 4 + 1
+    output_tokens = len(text) // 4 + 1
+    return {
+        "candidates": [{
+            "content": {"parts": [{"text": text}], "role": "model"},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        },
+        "modelVersion": model,
+    }
+
+
+class FakeGeminiState:
+    """
+    Trạng thái dùng chung của server: quota theo từng key (cửa sổ trượt), lỗi ngẫu nhiên và thống kê
+    """
+
+    def __init__(self, latency="fixed:0", rate_limit_rate=0.0, invalid_key_rate=0.0, server_error_rate=0.0,
+                 retry_delay=5.0, key_rpm=0, service_account_rpm=0, invalid_keys=(), seed=None, quota_window=60.0):
+        self.latency = parse_latency(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.invalid_key_rate = invalid_key_rate
+        self.server_error_rate = server_error_rate
+        self.retry_delay = retry_delay
+        self.key_rpm = key_rpm
+        self.service_account_rpm = service_account_rpm
+        self.quota_window = quota_window
+        self.invalid_keys = {f"key:{key}" for key in invalid_keys}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.windows = defaultdict(deque)
+            self.status_counts = defaultdict(int)
+            self.identity_counts = defaultdict(int)
+            self.latencies = []
+            self.started_at = time.time()
+
+    def _quota_retry_delay(self, identity, now):
+        """Thời gian (giây) đến khi key có slot trong cửa sổ quota hiện tại, None nếu còn quota"""
+        limit = self.service_account_rpm if identity == SERVICE_ACCOUNT_IDENTITY else self.key_rpm
+        if not limit:
+            return None
+
+        window = self.windows[identity]
+        while window and now - window[0] >= self.quota_window:
+            window.popleft()
+        if len(window) >= limit:
+            return self.quota_window - (now - window[0])
+        window.append(now)
+        return None
+
+    def decide(self, identity):
+        """
+        Chọn kết quả cho một request
+
+        Returns:
+            tuple: (độ trễ, mã HTTP, body lỗi hoặc None nếu thành công)
+        """
+        now = time.time()
+        with self.lock:
+            self.identity_counts[identity] += 1
+            latency = self.latency(self.rng)
+
+            if identity in self.invalid_keys:
+                return latency, 400, invalid_key_body()
+
+            quota_delay = self._quota_retry_delay(identity, now)
+            if quota_delay is not None:
+                return 0.0, 429, rate_limit_body(quota_delay, "GenerateRequestsPerMinutePerProjectPerModel",
+                                                 "generativelanguage.googleapis.com/generate_content_requests")
+
+            roll = self.rng.random()
+            if roll < self.rate_limit_rate:
+                return 0.0, 429, rate_limit_body(self.retry_delay, "GenerateRequestsPerMinutePerProjectPerModel-FreeTier",
+                                                 "generativelanguage.googleapis.com/generate_content_free_tier_requests")
+            roll -= self.rate_limit_rate
+            if roll < self.invalid_key_rate:
+                return latency, 400, invalid_key_body()
+            roll -= self.invalid_key_rate
+            if roll < self.server_error_rate:
+                return latency, 500, internal_error_body()
+            return latency, 200, None
+
+    def record(self, status_code, elapsed):
+        with self.lock:
+            self.status_counts[status_code] += 1
+            if status_code == 200:
+                self.latencies.append(elapsed)
+
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            total = sum(self.status_counts.values())
+            elapsed = max(time.time() - self.started_at, 1e-9)
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 4)
+
+            return {
+                "requests": total,
+                "requests_per_second": round(total / elapsed, 2),
+                "status_counts": {str(code): count for code, count in sorted(self.status_counts.items())},
+                "requests_per_identity": dict(self.identity_counts),
+                "latency_p50": percentile(50),
+                "latency_p95": percentile(95),
+                "latency_p99": percentile(99),
+            }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    """Handler REST cho models/{model}:generateContent (như google.ai.generativelanguage với transport="rest")"""
+
+    state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status_code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _identity(self, query):
+        api_key = self.headers.get("x-goog-api-key") or query.get("key", [None])[0]
+        return f"key:{api_key}" if api_key else SERVICE_ACCOUNT_IDENTITY
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self._send_json(200, self.state.get_stats())
+        else:
+            self._send_json(404, error_body(404, "NOT_FOUND", "Not found"))
+
+    def do_POST(self):
+        started = time.time()
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+
+        if url.path == "/reset":
+            self.state.reset()
+            self._send_json(200, {})
+            return
+
+        match = GENERATE_PATH_PATTERN.match(url.path)
+        if not match:
+            self._send_json(404, error_body(404, "NOT_FOUND", f"Unknown path {url.path}"))
+            return
+
+        identity = self._identity(parse_qs(url.query))
+        latency, status_code, error = self.state.decide(identity)
+        if latency > 0:
+            time.sleep(latency)
+
+        if error is not None:
+            response = error
+        else:
+            try:
+                request = json.loads(body or b"{}")
+                prompt = "".join(part.get("text", "")
+                                 for content in request.get("contents", [])
+                                 for part in content.get("parts", []))
+                text = fake_text(prompt, request.get("generationConfig", {}))
+                response = success_body(match.group("model"), text, prompt)
+            except ValueError as e:
+                status_code, response = 400, error_body(400, "INVALID_ARGUMENT", f"Invalid JSON payload: {e}")
+
+        self._send_json(status_code, response)
+        self.state.record(status_code, time.time() - started)
+
+
+def create_server(host="127.0.0.1", port=8765, **state_options):
+    """Tạo server giả lập (port=0 để hệ điều hành chọn port trống)"""
+    handler = type("ConfiguredFakeGeminiHandler", (FakeGeminiHandler,), {"state": FakeGeminiState(**state_options)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server Gemini giả lập để đo tải offline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:0.7,0.5",
+                        help="fixed:S | uniform:A,B | normal:MEAN,STD | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Tỉ lệ lỗi 429 ngẫu nhiên")
+    parser.add_argument("--invalid-key", type=float, default=0.0, help="Tỉ lệ lỗi 400 API key invalid ngẫu nhiên")
+    parser.add_argument("--server-error", type=float, default=0.0, help="Tỉ lệ lỗi 500 ngẫu nhiên")
+    parser.add_argument("--retry-delay", type=float, default=5.0, help="RetryInfo (giây) của lỗi 429 ngẫu nhiên")
+    parser.add_argument("--key-rpm", type=int, default=0, help="Quota request/phút cho mỗi API key (0 = không giới hạn)")
+    parser.add_argument("--service-account-rpm", type=int, default=0, help="Quota request/phút cho Service Account")
+    parser.add_argument("--invalid-keys", default="", help="Danh sách API key luôn trả lỗi 400, cách nhau bởi dấu phẩy")
+    parser.add_argument("--quota-window", type=float, default=60.0,
+                        help="Độ dài cửa sổ quota (giây) của --key-rpm/--service-account-rpm, rút ngắn để đo nhanh")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = create_server(
+        args.host, args.port,
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit,
+        invalid_key_rate=args.invalid_key,
+        server_error_rate=args.server_error,
+        retry_delay=args.retry_delay,
+        key_rpm=args.key_rpm,
+        service_account_rpm=args.service_account_rpm,
+        invalid_keys=[key for key in args.invalid_keys.split(",") if key],
+        seed=args.seed,
+        quota_window=args.quota_window,
+    )
+    print(f"🧪 Server Gemini giả lập chạy tại http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from logger_config import logger
+from utils.helpers import build_feedback_prompt
+
+# Nhật ký nhận xét đã tạo, dùng để chạy tiếp khi quá trình bị dừng giữa chừng
+JOURNAL_FILE = "data/cache/feedback_journal.sqlite3"
+
+
+def student_key(index, task_args):
+    """Khóa học sinh trong một sheet: dòng + họ tên + lớp"""
+    student_name, class_name = task_args[0], task_args[1]
+    return f"{index}|{str(student_name).strip()}|{class_name}"
+
+
+def prompt_hash(task_args):
+    """Hash prompt của học sinh (dữ liệu đổi thì prompt đổi, nhận xét cũ không còn dùng được)"""
+    return hashlib.sha256(build_feedback_prompt(task_args).encode("utf-8")).hexdigest()
+
+
+class FeedbackJournal:
+    """
+    Nhật ký SQLite lưu (sheet, khóa học sinh, hash prompt) -> nhận xét ngay khi nhận được.
+    Chỉ tiến trình chính ghi vào nhật ký; kết nối được mở khi dùng lần đầu và dùng chung giữa các thread
+    của tiến trình chính (pipeline ghi từ các thread của stage nhận xét), mọi thao tác đi qua self.lock.
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS feedback ("
+                "sheet TEXT NOT NULL, student_key TEXT NOT NULL, prompt_hash TEXT NOT NULL, "
+                "comment TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (sheet, student_key, prompt_hash))"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def record(self, sheet_name, index, task_args, comment):
+        """Ghi nhận xét của một học sinh (commit ngay để không mất khi bị dừng)"""
+        row = (sheet_name, student_key(index, task_args), prompt_hash(task_args), comment, time.time())
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO feedback (sheet, student_key, prompt_hash, comment, created_at) VALUES (?, ?, ?, ?, ?)",
+                row
+            )
+            conn.commit()
+
+    def split_completed(self, sheet_name, tasks):
+        """
+        Tách các task đã có nhận xét trong nhật ký
+
+        Args:
+            sheet_name (str): Tên sheet
+            tasks (list): Danh sách (index, task_args)
+
+        Returns:
+            tuple: (danh sách task còn thiếu, {index: nhận xét đã có})
+        """
+        with self.lock:
+            conn = self._connect()
+            saved = {
+                (key, hashed): comment
+                for key, hashed, comment in conn.execute(
+                    "SELECT student_key, prompt_hash, comment FROM feedback WHERE sheet = ?", (sheet_name,)
+                )
+            }
+
+        pending = []
+        completed = {}
+        for index, task_args in tasks:
+            comment = saved.get((student_key(index, task_args), prompt_hash(task_args)))
+            if comment is None:
+                pending.append((index, task_args))
+            else:
+                completed[index] = comment
+
+        if completed:
+            logger.info(f"⏭️ Sheet {sheet_name}: dùng lại {len(completed)} nhận xét từ nhật ký, còn {len(pending)} học sinh cần tạo")
+
+        return pending, completed
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+# Global feedback journal
+feedback_journal = FeedbackJournal()
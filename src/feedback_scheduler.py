@@ -0,0 +1,174 @@
+import os
+import time
+import heapq
+import itertools
+from collections import namedtuple
+from concurrent.futures import wait, FIRST_COMPLETED
+from logger_config import logger
+
+# Quy tắc ưu tiên, vd. "Mã trường=M01,M02@1800;Lớp=6A1;sheet=Khối 6":
+# quy tắc đứng trước được làm trước, "@giây" là hạn chót (tính từ lúc bắt đầu) cho các học sinh khớp quy tắc
+FEEDBACK_PRIORITY = os.getenv("FEEDBACK_PRIORITY", "")
+# Thời gian tối đa cho một request kể từ khi gửi cho worker (giây)
+FEEDBACK_TASK_TIMEOUT = float(os.getenv("FEEDBACK_TASK_TIMEOUT", 300))
+
+PriorityRule = namedtuple("PriorityRule", ["column", "values", "deadline"])
+
+# Kết quả của một task: status là "done", "error" hoặc "expired" (quá hạn, cần nhận xét dự phòng)
+ScheduledResult = namedtuple("ScheduledResult", ["key", "args", "status", "result", "error"])
+
+SHEET_COLUMN = "sheet"
+
+
+def parse_priority_rules(spec=FEEDBACK_PRIORITY):
+    """Đọc quy tắc ưu tiên dạng "cột=giá trị1,giá trị2[@giây];..." """
+    rules = []
+    for part in spec.split(";"):
+        if "=" not in part:
+            continue
+        column, _, values = part.partition("=")
+        deadline = None
+        if "@" in values:
+            values, _, deadline = values.rpartition("@")
+            deadline = float(deadline)
+        rules.append(PriorityRule(column.strip(), {value.strip() for value in values.split(",") if value.strip()}, deadline))
+    return rules
+
+
+def task_priority(row, sheet_name="", rules=None):
+    """
+    Lớp ưu tiên (số nhỏ làm trước) và hạn chót (giây từ lúc bắt đầu, None nếu không có) của một học sinh
+
+    Args:
+        row (Series): Dòng kết quả của học sinh
+        sheet_name (str): Tên sheet (quy tắc "sheet=...")
+    """
+    rules = parse_priority_rules() if rules is None else rules
+    for priority, rule in enumerate(rules):
+        value = sheet_name if rule.column == SHEET_COLUMN else row.get(rule.column)
+        if str(value).strip() in rule.values:
+            return priority, rule.deadline
+    return len(rules), None
+
+
+class FeedbackScheduler:
+    """
+    Hàng đợi ưu tiên đặt trước executor: task chỉ được gửi cho worker khi có chỗ trống
+    (tối đa max_in_flight), task ưu tiên cao / hạn chót sớm được gửi trước.
+    Kết quả được trả về theo thứ tự hoàn thành; task quá hạn chót hoặc chạy quá task_timeout
+    được trả về với status "expired" thay vì giữ cả batch chờ.
+    """
+
+    def __init__(self, executor, fn, max_in_flight, task_timeout=FEEDBACK_TASK_TIMEOUT):
+        self.executor = executor
+        self.fn = fn
+        self.max_in_flight = max(1, max_in_flight)
+        self.task_timeout = task_timeout
+        self.start_time = time.time()
+        self._queue = []
+        # Hạn chót của các task còn trong hàng đợi, để báo quá hạn ngay cả khi chưa đến lượt gửi
+        self._deadlines = []
+        # Task còn trong hàng đợi: sequence -> (key, args); mục trong 2 heap không còn ở đây thì bỏ qua
+        self._queued = {}
+        self._sequence = itertools.count()
+        self._in_flight = {}
+        self._abandoned = set()
+        self.expired = 0
+
+    def submit(self, key, args, priority=0, deadline=None):
+        """
+        Thêm task vào hàng đợi
+
+        Args:
+            key: Khóa của task (vd. index trong DataFrame)
+            args: Tham số cho fn
+            priority (int): Số nhỏ làm trước
+            deadline (float, optional): Hạn chót, tính bằng giây từ lúc tạo scheduler
+        """
+        absolute_deadline = self.start_time + deadline if deadline is not None else float("inf")
+        sequence = next(self._sequence)
+        self._queued[sequence] = (key, args)
+        heapq.heappush(self._queue, (priority, absolute_deadline, sequence))
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (absolute_deadline, sequence))
+
+    def pending(self):
+        return len(self._queued) + len(self._in_flight)
+
+    def cancel(self):
+        """Bỏ các task chưa gửi và không chờ các task đang chạy"""
+        self._queue.clear()
+        self._deadlines.clear()
+        self._queued.clear()
+        for future in self._in_flight:
+            future.cancel()
+        self._in_flight.clear()
+
+    def _expire_queued(self, now):
+        """Lấy ra các task quá hạn chót khi còn trong hàng đợi (không chờ đến lượt gửi)"""
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, sequence = heapq.heappop(self._deadlines)
+            task = self._queued.pop(sequence, None)
+            if task is not None:
+                expired.append(ScheduledResult(*task, "expired", None, None))
+        return expired
+
+    def _next_queued_deadline(self):
+        while self._deadlines and self._deadlines[0][1] not in self._queued:
+            heapq.heappop(self._deadlines)
+        return self._deadlines[0][0] if self._deadlines else float("inf")
+
+    def _fill(self, now):
+        """Gửi task cho worker khi còn chỗ"""
+        while self._queue and len(self._in_flight) + len(self._abandoned) < self.max_in_flight:
+            _, absolute_deadline, sequence = heapq.heappop(self._queue)
+            task = self._queued.pop(sequence, None)
+            if task is None:
+                continue
+            key, args = task
+            future = self.executor.submit(self.fn, args)
+            self._in_flight[future] = (key, args, min(absolute_deadline, now + self.task_timeout))
+
+    def _expire_running(self, now):
+        expired = []
+        for future, (key, args, expires_at) in list(self._in_flight.items()):
+            if expires_at <= now and not future.done():
+                del self._in_flight[future]
+                # Worker vẫn đang chạy task này: giữ chỗ cho đến khi nó xong
+                if not future.cancel():
+                    self._abandoned.add(future)
+                expired.append(ScheduledResult(key, args, "expired", None, None))
+        return expired
+
+    def as_completed(self):
+        """Generator trả về ScheduledResult theo thứ tự hoàn thành cho đến khi hết task"""
+        while self._queued or self._in_flight:
+            now = time.time()
+            for item in self._expire_queued(now):
+                self.expired += 1
+                logger.warning(f"⏰ Task {item.key} quá hạn khi còn trong hàng đợi, dùng nhận xét dự phòng")
+                yield item
+            self._fill(now)
+            if not self._in_flight and not self._abandoned:
+                continue
+
+            # Chờ task xong, đến hạn của task đang chạy sớm nhất hoặc hạn chót sớm nhất trong hàng đợi
+            next_expiry = min([expires_at for _, _, expires_at in self._in_flight.values()] + [self._next_queued_deadline()])
+            timeout = max(0.0, next_expiry - time.time()) if next_expiry != float("inf") else None
+            done, _ = wait(list(self._in_flight) + list(self._abandoned), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            self._abandoned -= done
+            for future in done:
+                if future not in self._in_flight:
+                    continue
+                key, args, _ = self._in_flight.pop(future)
+                try:
+                    yield ScheduledResult(key, args, "done", future.result(), None)
+                except Exception as e:
+                    yield ScheduledResult(key, args, "error", None, e)
+
+            for item in self._expire_running(time.time()):
+                self.expired += 1
+                logger.warning(f"⏰ Task {item.key} quá hạn, dùng nhận xét dự phòng")
+                yield item
@@ -0,0 +1,78 @@
+import asyncio
+import google.generativeai as genai
+from google.auth.credentials import AnonymousCredentials
+from logger_config import logger
+from utils.helpers import GEMINI_MODEL, GEMINI_API_ENDPOINT
+
+# Cache model Gemini trong tiến trình hiện tại, theo từng credential.
+# Model giữ client (kênh HTTP/gRPC) tạo ra ở lần gọi đầu tiên nên dùng lại được
+# kể cả khi tiến trình đã configure sang credential khác.
+_models = {}
+_configured_auth = None
+
+
+def _auth_id(auth_type, auth_value):
+    # Credentials của Service Account tự làm mới token khi sắp hết hạn, chỉ cần giữ cùng một object
+    return (auth_type, auth_value if auth_type == "api_key" else id(auth_value))
+
+
+def client_options():
+    """
+    Tham số genai.configure cho endpoint thay thế (GEMINI_API_ENDPOINT): REST tới endpoint đó
+    thay vì gRPC tới generativelanguage.googleapis.com
+    """
+    if not GEMINI_API_ENDPOINT:
+        return {}
+    return {"transport": "rest", "client_options": {"api_endpoint": GEMINI_API_ENDPOINT}}
+
+
+def get_model(auth_type, auth_value):
+    """
+    Lấy GenerativeModel cho credential (tạo một lần mỗi tiến trình).
+    Chỉ gọi genai.configure khi chuyển sang credential chưa có model.
+
+    Args:
+        auth_type (str): "api_key" hoặc "service_account"
+        auth_value: API key hoặc object Credentials của Service Account
+    """
+    global _configured_auth
+
+    auth_id = _auth_id(auth_type, auth_value)
+    model = _models.get(auth_id)
+    if model is not None:
+        return model
+
+    if _configured_auth != auth_id:
+        if auth_type == "api_key":
+            genai.configure(api_key=auth_value, **client_options())
+        elif GEMINI_API_ENDPOINT:
+            # Endpoint thay thế không xác thực OAuth, không cần lấy token của Service Account
+            genai.configure(credentials=AnonymousCredentials(), **client_options())
+        else:
+            genai.configure(credentials=auth_value)
+        _configured_auth = auth_id
+
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    _models[auth_id] = model
+    logger.debug(f"🔌 Tạo client Gemini mới ({auth_type}), đang cache {len(_models)} client")
+    return model
+
+
+def forget_model(auth_type, auth_value):
+    """Bỏ model đã cache của credential (key invalid hoặc client bị lỗi)"""
+    global _configured_auth
+
+    auth_id = _auth_id(auth_type, auth_value)
+    _models.pop(auth_id, None)
+    if _configured_auth == auth_id:
+        _configured_auth = None
+
+
+async def generate_content_async(model, prompt, **kwargs):
+    """
+    generate_content_async của model; client async chỉ hỗ trợ gRPC nên với endpoint thay thế (REST)
+    request được gửi bằng client đồng bộ trong thread pool của event loop
+    """
+    if GEMINI_API_ENDPOINT:
+        return await asyncio.to_thread(model.generate_content, prompt, **kwargs)
+    return await model.generate_content_async(prompt, **kwargs)
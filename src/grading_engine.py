@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+from logger_config import logger
+
+# Mã hóa kết quả từng câu trong ma trận điểm
+CODE_EMPTY = 0  # Ô trống hoặc giá trị không nhận dạng được
+CODE_CORRECT = 1
+CODE_WRONG = 2
+CODE_SKIPPED = 3
+
+# Bao gồm cả biến thể "Ð" do xử lý đáp án câu Đúng/Sai bằng VBA trên Excel (tạm thời)
+RESULT_CODES = {
+    "Đúng": CODE_CORRECT,
+    "Ðúng": CODE_CORRECT,
+    "Sai": CODE_WRONG,
+    "Bỏ qua": CODE_SKIPPED,
+}
+
+def find_result_columns(df1):
+    """Tìm vị trí các cột kết quả (Đúng/Sai/Bỏ qua) dựa trên dòng thứ 2 của sheet"""
+    result_indices = []
+    sample_row = df1.iloc[1].to_numpy()
+
+    for i, value in enumerate(sample_row):
+        if pd.notna(value):
+            val = str(value).strip()
+            val = val.replace("Ð", "Đ")
+
+            if val in ['Đúng', 'Sai', 'Bỏ qua']:
+                result_indices.append(i)
+
+    return result_indices
+
+
+def build_code_matrix(df1, result_indices):
+    """Chuyển khối cột kết quả thành ma trận mã (học sinh x câu hỏi) kiểu int8"""
+    n_students = len(df1)
+    n_questions = len(result_indices)
+    if n_students == 0 or n_questions == 0:
+        return np.zeros((n_students, n_questions), dtype=np.int8)
+
+    block = df1.iloc[:, result_indices].to_numpy(dtype=object)
+    flat = pd.Series(block.ravel(order="F"))
+
+    empty_cells = int(flat.isna().sum())
+    if empty_cells:
+        logger.warning(f"⚠️ Có {empty_cells} ô kết quả bị trống, bỏ qua khi chấm điểm")
+
+    codes = flat.map(RESULT_CODES).fillna(CODE_EMPTY).to_numpy(dtype=np.int8)
+    return codes.reshape((n_students, n_questions), order="F")
+
+
+def format_percent_list(counts, total):
+    """Định dạng tỉ lệ phần trăm theo cấp độ, dùng bảng tra cho mọi giá trị có thể có"""
+    if total <= 0:
+        return ["0%"] * len(counts)
+
+    table = np.array([f"{int(round((value / total) * 100, 0))}%" for value in range(total + 1)], dtype=object)
+    return table[np.clip(counts, 0, total)].tolist()
+
+
+# Số bit 1 của mọi giá trị uint8, dùng để đếm bit (popcount) trên bitset
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def pack_mask(mask):
+    """Đóng gói mask theo câu hỏi (bool) thành bitset cùng định dạng với AnswerBitsets"""
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+
+class AnswerBitsets:
+    """
+    Kết quả của từng học sinh dưới dạng 3 bitset đóng gói (đúng, sai, bỏ qua) trên trục câu hỏi.
+    Mỗi dòng là một học sinh, bit thứ i (MSB trước) ứng với câu i + 1.
+    """
+
+    def __init__(self, codes):
+        self.n_students, self.n_questions = codes.shape
+        self.correct = np.packbits(codes == CODE_CORRECT, axis=1)
+        self.wrong = np.packbits(codes == CODE_WRONG, axis=1)
+        self.skipped = np.packbits(codes == CODE_SKIPPED, axis=1)
+
+    def count(self, bits, mask=None):
+        """Đếm số bit 1 của từng học sinh, có thể lọc theo bitset `mask` của câu hỏi"""
+        if mask is not None:
+            bits = bits & mask
+        return POPCOUNT_TABLE[bits].sum(axis=1, dtype=np.int64)
+
+    def questions(self, bits, student):
+        """Danh sách số thứ tự câu hỏi có bit 1 của một học sinh"""
+        return (np.flatnonzero(np.unpackbits(bits[student], count=self.n_questions)) + 1).tolist()
+
+    def questions_by_student(self, bits):
+        """Danh sách số thứ tự câu hỏi có bit 1 cho từng học sinh"""
+        if self.n_students == 0:
+            return []
+
+        rows, cols = np.nonzero(np.unpackbits(bits, axis=1, count=self.n_questions))
+        split_points = np.cumsum(np.bincount(rows, minlength=self.n_students))[:-1]
+        return [(group + 1).tolist() for group in np.split(cols, split_points)]
+
+    def format_questions(self, bits, empty_text="Không có"):
+        """Tạo chuỗi "Câu 1, Câu 3, ..." cho từng học sinh"""
+        if self.n_students == 0:
+            return []
+
+        labels = np.array([f"Câu {q}" for q in range(1, self.n_questions + 1)], dtype=object)
+        rows, cols = np.nonzero(np.unpackbits(bits, axis=1, count=self.n_questions))
+        split_points = np.cumsum(np.bincount(rows, minlength=self.n_students))[:-1]
+
+        return [", ".join(group) if len(group) else empty_text for group in np.split(labels[cols], split_points)]
+
+
+def grade_sheet(df1, question_index, result_indices):
+    """
+    Chấm điểm toàn bộ sheet bằng các phép toán trên bitset
+
+    Returns:
+        dict: Các cột kết quả (Đúng, Sai, Bỏ qua, Các câu sai, tỉ lệ theo cấp độ),
+              danh sách câu sai/bỏ qua của từng học sinh và các bitset kết quả
+    """
+    bitsets = AnswerBitsets(build_code_matrix(df1, result_indices))
+    basic_mask, advanced_mask = question_index.level_masks(bitsets.n_questions)
+
+    correct_basic = bitsets.count(bitsets.correct, pack_mask(basic_mask))
+    correct_advanced = bitsets.count(bitsets.correct, pack_mask(advanced_mask))
+
+    return {
+        "correct": bitsets.count(bitsets.correct),
+        "wrong": bitsets.count(bitsets.wrong),
+        "skipped": bitsets.count(bitsets.skipped),
+        "wrong_questions_string": bitsets.format_questions(bitsets.wrong),
+        "percent_basic": format_percent_list(correct_basic, question_index.total_basic),
+        "percent_advanced": format_percent_list(correct_advanced, question_index.total_advanced),
+        "missed_questions": bitsets.questions_by_student(bitsets.wrong | bitsets.skipped),
+        "bitsets": bitsets,
+    }
@@ -0,0 +1,187 @@
+import json
+from collections import OrderedDict, namedtuple
+
+# Cột chứa "Nội dung cần cải thiện" dạng cấu trúc (JSON) để bước tạo PDF không phải parse lại chuỗi
+IMPROVEMENT_STRUCTURE_COLUMN = "Cấu trúc cải thiện"
+
+# Chuỗi hiển thị (output.xlsx, prompt nhận xét) và cấu trúc JSON của cùng một nội dung
+ImprovementContent = namedtuple("ImprovementContent", ["text", "structure"])
+
+
+def build_grouped_dict(questions, question_index):
+    """Nhóm các câu sai/bỏ qua theo cấu trúc: Môn → Chủ đề → Chương → Bài (với link)"""
+    grouped_dict = {}
+
+    for q in questions:
+        info = question_index.get(q)
+        if info is None:
+            continue
+
+        subject, topic, chapter, lesson, link = info.subject, info.topic, info.chapter, info.lesson, info.link
+
+        if subject and topic and chapter and lesson:
+            # Case 1 - Full structure
+            if subject not in grouped_dict:
+                grouped_dict[subject] = {}
+            if topic not in grouped_dict[subject]:
+                grouped_dict[subject][topic] = {}
+            if chapter not in grouped_dict[subject][topic]:
+                grouped_dict[subject][topic][chapter] = {}
+            grouped_dict[subject][topic][chapter][lesson] = link if link else ""
+        elif subject and topic and chapter:
+            # Case 2 - No lesson
+            if subject not in grouped_dict:
+                grouped_dict[subject] = {}
+            if topic not in grouped_dict[subject]:
+                grouped_dict[subject][topic] = {}
+            grouped_dict[subject][topic][chapter] = link if link else ""
+        elif topic and chapter and lesson:
+            # Case 3 - No subject
+            if topic not in grouped_dict:
+                grouped_dict[topic] = {}
+            if chapter not in grouped_dict[topic]:
+                grouped_dict[topic][chapter] = {}
+            grouped_dict[topic][chapter][lesson] = link if link else ""
+        elif topic and chapter:
+            # Case 4 - Topic and chapter only
+            if topic not in grouped_dict:
+                grouped_dict[topic] = {}
+            grouped_dict[topic][chapter] = link if link else ""
+        elif topic and lesson:
+            # Case 5 - Topic and lesson only
+            if topic not in grouped_dict:
+                grouped_dict[topic] = {}
+            grouped_dict[topic][lesson] = link if link else ""
+
+    return grouped_dict
+
+
+def format_grouped_dict(grouped_dict, has_subject):
+    """Định dạng chuỗi "Nội dung cần cải thiện" từ cấu trúc đã nhóm"""
+    formatted_parts = []
+
+    if has_subject:
+        for subject, topics in grouped_dict.items():
+            for topic, chapters in topics.items():
+                if isinstance(chapters, dict):  # Có chương
+                    for chapter, lessons in chapters.items():
+                        if isinstance(lessons, dict):  # Bài học với link
+                            lesson_list = []
+                            for lesson, link in lessons.items():
+                                if link:
+                                    lesson_list.append(f"{lesson} ({link})")
+                                else:
+                                    lesson_list.append(lesson)
+                            formatted_parts.append(f"Môn {subject} - Chủ đề {topic} - Chương {chapter}: {' - '.join(sorted(lesson_list))}")
+                        else:  # Trường hợp không có bài
+                            formatted_parts.append(f"Môn {subject} - Chủ đề {topic} - Chương {chapter}")
+                else:  # Không có chương
+                    formatted_parts.append(f"Môn {subject} - Chủ đề {topic}: {' - '.join(sorted(chapters))}")
+    else:
+        for topic, chapters in grouped_dict.items():
+            if isinstance(chapters, dict):
+                for chapter, lessons in chapters.items():
+                    if isinstance(lessons, dict):
+                        lesson_list = []
+                        for lesson, link in lessons.items():
+                            if link:
+                                lesson_list.append(f"{lesson} ({link})")
+                            else:
+                                lesson_list.append(lesson)
+                        formatted_parts.append(f"Chủ đề {topic} - Chương {chapter}: {' - '.join(sorted(lesson_list))}")
+                    else:
+                        lesson_text = f"{chapter} ({lessons})" if lessons else chapter
+                        formatted_parts.append(f"Chủ đề {topic}: {lesson_text}")
+
+    return "; ".join(formatted_parts) if formatted_parts else ""
+
+
+def _sorted_lessons(lessons):
+    """Các [bài, link] theo đúng thứ tự của chuỗi đã định dạng (sắp theo "bài (link)")"""
+    lesson_list = [(f"{lesson} ({link})" if link else lesson, lesson, link or None) for lesson, link in lessons.items()]
+    return [[lesson, link] for _, lesson, link in sorted(lesson_list)]
+
+
+def build_improvement_parts(grouped_dict, has_subject):
+    """
+    Các mục của "Nội dung cần cải thiện" dạng cấu trúc, cùng thứ tự với format_grouped_dict:
+    [môn, chủ đề, chương, [[bài, link], ...]]; môn, chương, link là None nếu không có.
+    Tên bài được giữ nguyên, không bị nhầm khi có " - " hoặc ":" trong tên.
+    """
+    parts = []
+
+    if has_subject:
+        for subject, topics in grouped_dict.items():
+            for topic, chapters in topics.items():
+                if isinstance(chapters, dict):
+                    for chapter, lessons in chapters.items():
+                        if isinstance(lessons, dict):
+                            parts.append([subject, topic, chapter, _sorted_lessons(lessons)])
+                        else:  # Trường hợp không có bài
+                            parts.append([subject, topic, chapter, []])
+                else:  # Mục không có môn (chủ đề → chương → link) trong ma trận có cột Môn
+                    parts.append([None, subject, None, [[topic, chapters or None]]])
+    else:
+        for topic, chapters in grouped_dict.items():
+            if isinstance(chapters, dict):
+                for chapter, lessons in chapters.items():
+                    if isinstance(lessons, dict):
+                        parts.append([None, topic, chapter, _sorted_lessons(lessons)])
+                    else:
+                        parts.append([None, topic, None, [[chapter, lessons or None]]])
+
+    return parts
+
+
+def serialize_improvement_parts(parts):
+    """JSON gọn của build_improvement_parts (chuỗi rỗng nếu không có nội dung)"""
+    return json.dumps(parts, ensure_ascii=False, separators=(",", ":")) if parts else ""
+
+
+class ImprovementContentCache:
+    """
+    Cache LRU cho "Nội dung cần cải thiện" (chuỗi và cấu trúc JSON), khóa theo tập câu sai/bỏ qua.
+    Các học sinh sai cùng một tập câu chỉ tốn một lần tra cứu dict.
+    """
+
+    def __init__(self, question_index, max_size=4096):
+        self.question_index = question_index
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, missed_questions):
+        """Lấy ImprovementContent cho tập câu sai/bỏ qua (tạo mới nếu chưa có)"""
+        key = frozenset(missed_questions)
+
+        content = self.entries.get(key)
+        if content is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return content
+
+        self.misses += 1
+        # Duyệt theo thứ tự câu hỏi để kết quả ổn định giữa các lần chạy
+        grouped_dict = build_grouped_dict(sorted(key), self.question_index)
+        has_subject = self.question_index.has_subject
+        content = ImprovementContent(
+            format_grouped_dict(grouped_dict, has_subject),
+            serialize_improvement_parts(build_improvement_parts(grouped_dict, has_subject)),
+        )
+
+        self.entries[key] = content
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return content
+
+    def get_stats(self):
+        """Lấy thống kê cache"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
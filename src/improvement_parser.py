@@ -0,0 +1,261 @@
+import re
+import json
+from collections import namedtuple
+from functools import lru_cache
+from improvement_content import IMPROVEMENT_STRUCTURE_COLUMN
+
+# Các mẫu của chuỗi "Nội dung cần cải thiện" / "Nội dung câu trả lời sai", biên dịch một lần
+ENTRY_SEPARATOR = ";"
+SUBJECT_ENTRY_RE = re.compile(r"(.+?)\s*-\s*(.+?):\s*(.+)")
+TOPIC_LINK_ENTRY_RE = re.compile(r"Chủ đề\s*(.+?):\s*(.+?)\s*\((https?://.+?)\)")
+TOPIC_ENTRY_RE = re.compile(r"Chủ đề\s*(.+?):\s*(.+?)$")
+TOPIC_CHAPTER_ENTRY_RE = re.compile(r"Chủ đề\s*(.+?)(?:\s*-\s*Chương\s*(.+?))?:\s*(.+)(?:\s*\((https?://.+?)\))?")
+SIMPLE_ENTRY_RE = re.compile(r"(.+?):\s*(.+)")
+WRONG_ANSWER_LINK_RE = re.compile(r"(.+?) - (.+?): (.+?)\s*\((https?://[^\)]+)\)")
+WRONG_ANSWER_RE = re.compile(r"(.+?) - (.+?): (.+)")
+CORRECT_ANSWER_RE = re.compile(r"(.+) - (.+): (.+)")
+LESSON_LINK_RE = re.compile(r"(.+?)\s*\((https?://.+?)\)")
+
+# Môn được in trước trong báo cáo, các môn còn lại theo thứ tự xuất hiện
+SUBJECT_PRIORITY = ("Toán", "Ngữ Văn", "Tiếng Anh")
+
+PARSE_CACHE_SIZE = 4096
+
+# "Môn - Chủ đề: bài 1 - bài 2": contents là toàn bộ các bài, chưa cắt
+SubjectEntry = namedtuple("SubjectEntry", ["subject", "topic", "contents"])
+# Cây Môn → Chủ đề → bài đã chọn để in: topics là tuple các (chủ đề, tuple bài)
+SubjectGroup = namedtuple("SubjectGroup", ["subject", "topics"])
+# "Chủ đề X: bài 1, bài 2 (link)"
+TopicLessons = namedtuple("TopicLessons", ["topic", "lessons", "link"])
+# "Chủ đề X - Chương Y: bài (link)"; chapter là None nếu không có chương
+ChapterEntry = namedtuple("ChapterEntry", ["topic", "chapter", "lesson", "link"])
+# "Chủ đề: nội dung 1 - nội dung 2"
+SimpleTopic = namedtuple("SimpleTopic", ["topic", "contents"])
+# "Chủ đề - Nội dung: bài (link)" trong cột câu trả lời sai
+WrongAnswer = namedtuple("WrongAnswer", ["topic", "content", "exercise", "link"])
+# Tên bài và link (None nếu không có)
+Lesson = namedtuple("Lesson", ["title", "link"])
+# Một mục của cột IMPROVEMENT_STRUCTURE_COLUMN; subject / chapter là None nếu không có, lessons là tuple Lesson
+ImprovementPart = namedtuple("ImprovementPart", ["subject", "topic", "chapter", "lessons"])
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def load_improvement_parts(structure):
+    """Đọc cột cấu trúc (JSON) thành tuple ImprovementPart; None nếu dữ liệu hỏng (vd. bị cắt bớt trong Excel)"""
+    try:
+        return tuple(
+            ImprovementPart(subject, topic, chapter, tuple(Lesson(title, link) for title, link in lessons))
+            for subject, topic, chapter, lessons in json.loads(structure)
+        )
+    except (ValueError, TypeError):
+        return None
+
+
+def improvement_source(row, column='Nội dung cần cải thiện'):
+    """
+    Nội dung cần cải thiện của một học sinh cho các hàm parse bên dưới: các ImprovementPart từ cột cấu trúc
+    nếu có (không phải parse chuỗi), ngược lại là chuỗi trong column (file kết quả cũ)
+    """
+    structure = row.get(IMPROVEMENT_STRUCTURE_COLUMN)
+    if isinstance(structure, str) and structure.strip():
+        parts = load_improvement_parts(structure)
+        if parts is not None:
+            return parts
+    return row[column]
+
+
+def _lesson_text(lesson):
+    """Bài dạng chuỗi "bài (link)" như trong cột nội dung"""
+    return f"{lesson.title} ({lesson.link})" if lesson.link else lesson.title
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def split_entries(text):
+    """Tách chuỗi theo ";" thành các mục (đã bỏ khoảng trắng và mục rỗng)"""
+    return tuple(entry.strip() for entry in text.split(ENTRY_SEPARATOR) if entry.strip())
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def split_lesson_link(text):
+    """Tách "bài (https://...)" thành Lesson; trả về None nếu không có link"""
+    match = LESSON_LINK_RE.match(text)
+    if not match:
+        return None
+    return Lesson(*match.groups())
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_subject_entries(content):
+    """
+    Các mục dạng "Môn - Chủ đề: bài 1 - bài 2" (content là chuỗi nội dung hoặc các ImprovementPart).
+    Với ImprovementPart, nhãn được ghép giống chuỗi: "Môn X" / "Chủ đề Y - Chương Z", hoặc "Chủ đề Y" / "Chương Z".
+    """
+    entries = []
+    if not isinstance(content, str):
+        for part in content:
+            if part.chapter is None or not part.lessons:
+                continue
+            contents = tuple(_lesson_text(lesson) for lesson in part.lessons)
+            if part.subject is not None:
+                entries.append(SubjectEntry(f"Môn {part.subject}", f"Chủ đề {part.topic} - Chương {part.chapter}", contents))
+            else:
+                entries.append(SubjectEntry(f"Chủ đề {part.topic}", f"Chương {part.chapter}", contents))
+        return tuple(entries)
+
+    for entry in split_entries(content):
+        match = SUBJECT_ENTRY_RE.match(entry)
+        if match:
+            subject, topic, content_list = match.groups()
+            entries.append(SubjectEntry(subject.strip(), topic.strip(), tuple(c.strip() for c in content_list.split(" - "))))
+    return tuple(entries)
+
+
+def has_subject_entries(content):
+    """Có mục nào mà phần trước dấu "-" là môn (không phải "Chủ đề ...")"""
+    return any("Chủ đề" not in entry.subject for entry in parse_subject_entries(content))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_subject_tree(content, max_topics=4, max_items=2):
+    """
+    Cây Môn → Chủ đề → bài để in báo cáo: mỗi môn tối đa max_topics chủ đề (chủ đề lặp lại bị bỏ qua),
+    mỗi chủ đề tối đa max_items bài. Các môn trong SUBJECT_PRIORITY đứng trước.
+
+    Returns:
+        tuple: Các SubjectGroup theo thứ tự in
+    """
+    tree = {}
+    for entry in parse_subject_entries(content):
+        topics = tree.setdefault(entry.subject, {})
+        if len(topics) >= max_topics or entry.topic in topics:
+            continue
+        topics[entry.topic] = entry.contents[:max_items]
+
+    ordered = [subject for subject in SUBJECT_PRIORITY if subject in tree]
+    ordered += [subject for subject in tree if subject not in SUBJECT_PRIORITY]
+    return tuple(SubjectGroup(subject, tuple(tree[subject].items())) for subject in ordered)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_topic_lessons(content):
+    """Các mục dạng "Chủ đề X: bài 1, bài 2 (link)" (link có thể không có; content là chuỗi hoặc các ImprovementPart)"""
+    entries = []
+    if not isinstance(content, str):
+        for part in content:
+            if part.subject is not None or not part.lessons:
+                continue
+            topic = part.topic if part.chapter is None else f"{part.topic} - Chương {part.chapter}"
+            # Giống cách đọc chuỗi: mỗi mục một bài, gồm các bài đến bài có link đầu tiên (nối bằng " - ")
+            # và link của chính bài đó; các bài sau không được in
+            linked = next((i for i, lesson in enumerate(part.lessons) if lesson.link), None)
+            lessons = part.lessons if linked is None else part.lessons[:linked + 1]
+            link = None if linked is None else part.lessons[linked].link
+            entries.append(TopicLessons(topic, (" - ".join(lesson.title for lesson in lessons),), link))
+        return tuple(entries)
+
+    for entry in split_entries(content):
+        match = TOPIC_LINK_ENTRY_RE.match(entry)
+        if match:
+            topic, lessons, link = match.groups()
+        else:
+            match = TOPIC_ENTRY_RE.match(entry)
+            if not match:
+                continue
+            (topic, lessons), link = match.groups(), None
+        entries.append(TopicLessons(topic.strip(), tuple(lesson.strip() for lesson in lessons.strip().split(",")), link))
+    return tuple(entries)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_topic_chapters(content):
+    """Các mục dạng "Chủ đề X - Chương Y: bài (link)" (chương và link có thể không có; content là chuỗi hoặc các ImprovementPart)"""
+    entries = []
+    if not isinstance(content, str):
+        for part in content:
+            if part.subject is not None or not part.lessons:
+                continue
+            entries.append(ChapterEntry(part.topic, part.chapter, " - ".join(_lesson_text(lesson) for lesson in part.lessons), None))
+        return tuple(entries)
+
+    for entry in split_entries(content):
+        match = TOPIC_CHAPTER_ENTRY_RE.match(entry)
+        if match:
+            topic, chapter, lesson, link = match.groups()
+            entries.append(ChapterEntry(topic.strip(), chapter.strip() if chapter else None, lesson.strip(), link))
+    return tuple(entries)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_chapter_tree(content, max_topics=4):
+    """
+    Cây Chủ đề → Chương (hoặc bài nếu không có chương) → bài từ parse_topic_chapters:
+    chủ đề đóng vai trò môn, tối đa max_topics mục mỗi chủ đề. Các chủ đề trong SUBJECT_PRIORITY đứng trước.
+
+    Returns:
+        tuple: Các SubjectGroup theo thứ tự in
+    """
+    tree = {}
+    for entry in parse_topic_chapters(content):
+        keys = tree.setdefault(entry.topic, {})
+        key = entry.chapter if entry.chapter is not None else entry.lesson
+        if len(keys) >= max_topics or key in keys:
+            continue
+        keys[key] = (f"{entry.lesson} ({entry.link})" if entry.link else entry.lesson,)
+
+    ordered = [subject for subject in SUBJECT_PRIORITY if subject in tree]
+    ordered += [subject for subject in tree if subject not in SUBJECT_PRIORITY]
+    return tuple(SubjectGroup(subject, tuple(tree[subject].items())) for subject in ordered)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_simple_topics(content):
+    """Các mục dạng "Chủ đề: nội dung 1 - nội dung 2" (content là chuỗi hoặc các ImprovementPart)"""
+    entries = []
+    if not isinstance(content, str):
+        for part in content:
+            if part.subject is not None or part.chapter is not None or not part.lessons:
+                continue
+            entries.append(SimpleTopic(f"Chủ đề {part.topic}", tuple(_lesson_text(lesson) for lesson in part.lessons)))
+        return tuple(entries)
+
+    for entry in split_entries(content):
+        match = SIMPLE_ENTRY_RE.match(entry)
+        if match:
+            topic, content_list = match.groups()
+            entries.append(SimpleTopic(topic.strip(), tuple(c.strip() for c in content_list.split(" - "))))
+    return tuple(entries)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_wrong_answers(text):
+    """Các mục của cột "Nội dung câu trả lời sai": "Chủ đề - Nội dung: bài (link)" """
+    entries = []
+    for entry in split_entries(text):
+        match = WRONG_ANSWER_LINK_RE.match(entry)
+        if match:
+            entries.append(WrongAnswer(*match.groups()))
+            continue
+        match = WRONG_ANSWER_RE.match(entry)
+        if match:
+            entries.append(WrongAnswer(*match.groups(), None))
+    return tuple(entries)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_correct_topics(text):
+    """Chủ đề của từng mục trong cột "Nhận xét về kết quả bài thi" (theo thứ tự, có lặp)"""
+    topics = []
+    for entry in split_entries(text):
+        match = CORRECT_ANSWER_RE.match(entry)
+        if match:
+            topics.append(match.group(1))
+    return tuple(topics)
+
+
+def get_cache_info():
+    """Thống kê cache của các hàm parse (hits/misses)"""
+    return {
+        fn.__name__: fn.cache_info()._asdict()
+        for fn in (load_improvement_parts, split_entries, split_lesson_link, parse_subject_entries, parse_subject_tree, parse_topic_lessons,
+                   parse_topic_chapters, parse_chapter_tree, parse_simple_topics, parse_wrong_answers, parse_correct_topics)
+    }
@@ -1,5 +1,4 @@
 import os
-import pandas as pd
 import asyncio
 import multiprocessing as mp
 import json
@@ -11,6 +10,11 @@ from dotenv import load_dotenv
 from logger_config import logger
 from data_processor_module4 import handle_sheet, process_feedbacks, process_feedbacks_multiprocessing
 from service_account_processor import process_feedbacks_service_account, sa_processor
+from async_feedback_engine import process_feedbacks_async
+from sheet_scheduler import process_sheets_parallel
+from pipeline import run_pipeline
+from result_writer import StreamingResultWriter, DEFAULT_SIDE_FORMATS
+from workbook_loader import load_workbook_sheets
 
 load_dotenv()
 
@@ -133,35 +137,49 @@ def test_service_account():
         
         return False
 
-def processor_async(input_file1, input_file2, sheet_names=None):
+def processor_async(input_file1, input_file2, sheet_names=None, on_sheet_done=None, resume=False):
     """
-    Xử lý với phương pháp async (phương pháp cũ)
+    Xử lý với engine asyncio: chấm điểm tuần tự từng sheet, nhận xét chạy nhiều request đồng thời
+    trong một tiến trình (không cần process pool)
+
+    Nếu có on_sheet_done, mỗi sheet được chuyển cho on_sheet_done(sheet_name, df) ngay khi xong
+    và kết quả trả về là {tên sheet: số học sinh}
     """
     logger.info("Bắt đầu xử lý file Excel với phương pháp async...")
 
     try:
+        sheets1 = load_workbook_sheets(input_file1, sheet_names)
         if sheet_names is None:
-            xls = pd.ExcelFile(input_file1)
-            sheet_names = xls.sheet_names
+            sheet_names = list(sheets1.keys())
             logger.info(f"Tìm thấy {len(sheet_names)} sheet: {sheet_names}")
 
+        sheets2 = load_workbook_sheets(input_file2, sheet_names)
+
         result_dfs = {}
 
         for sheet_name in sheet_names:
             logger.info(f"Đọc dữ liệu từ sheet: {sheet_name}")
 
-            df1 = pd.read_excel(input_file1, sheet_name=sheet_name)
-            df2 = pd.read_excel(input_file2, sheet_name=sheet_name)
+            if sheet_name not in sheets1 or sheet_name not in sheets2:
+                raise ValueError(f"Worksheet named '{sheet_name}' not found")
+
+            df1 = sheets1.pop(sheet_name)
+            df2 = sheets2.pop(sheet_name)
 
             logger.info("Bắt đầu xử lý sheet...")
             result = handle_sheet(df1, df2)
 
-            # logger.info("Bắt đầu tạo nhận xét cho học sinh bằng async...")
-            # result_feedbacks = asyncio.run(process_feedbacks(result))
-
-            # result_dfs[sheet_name] = result_feedbacks
+            if sa_processor.service_account_creds:
+                logger.info("Bắt đầu tạo nhận xét cho học sinh bằng async...")
+                result = process_feedbacks_async(result, sheet_name=sheet_name, resume=resume)
+            else:
+                logger.error("❌ Không có Service Account credentials!")
 
-            result_dfs[sheet_name] = result
+            if on_sheet_done is not None:
+                on_sheet_done(sheet_name, result)
+                result_dfs[sheet_name] = len(result)
+            else:
+                result_dfs[sheet_name] = result
 
 
         return result_dfs
@@ -170,44 +188,25 @@ def processor_async(input_file1, input_file2, sheet_names=None):
         logger.error(f"Lỗi khi xử lý file với async: {e}")
         raise
 
-def processor_multiprocessing(input_file1, input_file2, sheet_names=None):
+def processor_multiprocessing(input_file1, input_file2, sheet_names=None, on_sheet_done=None, resume=False):
     """
-    Xử lý với multiprocessing
+    Xử lý với multiprocessing: chấm điểm các sheet song song, nhận xét qua một hàng đợi Service Account chung
+
+    Nếu có on_sheet_done, mỗi sheet được chuyển cho on_sheet_done(sheet_name, df) ngay khi xong
+    và kết quả trả về là {tên sheet: số học sinh}.
+    Với resume=True, học sinh đã có nhận xét trong nhật ký sẽ không phải gọi lại Gemini
     """
     logger.info("Bắt đầu xử lý file Excel với multiprocessing...")
 
     try:
+        sheets1 = load_workbook_sheets(input_file1, sheet_names)
         if sheet_names is None:
-            xls = pd.ExcelFile(input_file1)
-            sheet_names = xls.sheet_names
+            sheet_names = list(sheets1.keys())
             logger.info(f"Tìm thấy {len(sheet_names)} sheet: {sheet_names}")
-            xls.close()  # Đóng file để tránh memory leak
-
-        result_dfs = {}
-
-        for sheet_name in sheet_names:
-            logger.info(f"🔄 Xử lý sheet: {sheet_name}")
 
-            try:
-                df1 = pd.read_excel(input_file1, sheet_name=sheet_name)
-                df2 = pd.read_excel(input_file2, sheet_name=sheet_name)
-
-                logger.info(f"📊 Sheet {sheet_name}: {len(df1)} học sinh")
-                
-                # Xử lý sheet (không có AI feedback)
-                result = handle_sheet(df1, df2)
+        sheets2 = load_workbook_sheets(input_file2, sheet_names)
 
-                # Tạo nhận xét chỉ bằng Service Account
-                logger.info("🏢 Bắt đầu tạo nhận xét với Service Account...")
-                result_feedbacks = process_feedbacks_service_account(result)
-
-                result_dfs[sheet_name] = result_feedbacks
-                logger.info(f"✅ Hoàn thành sheet {sheet_name}")
-
-            except Exception as sheet_error:
-                logger.error(f"❌ Lỗi xử lý sheet {sheet_name}: {sheet_error}")
-                # Tiếp tục với sheet khác thay vì dừng hoàn toàn
-                continue
+        result_dfs = process_sheets_parallel(sheets1, sheets2, sheet_names, on_sheet_done=on_sheet_done, resume=resume)
 
         if not result_dfs:
             raise ValueError("Không có sheet nào được xử lý thành công!")
@@ -218,44 +217,81 @@ def processor_multiprocessing(input_file1, input_file2, sheet_names=None):
         logger.error(f"Lỗi khi xử lý file với multiprocessing: {e}")
         raise
 
-def processor(input_file1, input_file2, sheet_names=None, use_multiprocessing=True):
+def processor(input_file1, input_file2, sheet_names=None, use_multiprocessing=True, side_formats=DEFAULT_SIDE_FORMATS, resume=False):
     """
-    Hàm chính để xử lý file Excel và tạo nhận xét cho học sinh
+    Hàm chính để xử lý file Excel và tạo nhận xét cho học sinh.
+    Mỗi sheet được ghi vào output.xlsx ngay khi hoàn thành (theo thứ tự hoàn thành)
     
     Args:
         input_file1 (str): Đường dẫn file kết quả làm bài
         input_file2 (str): Đường dẫn file ma trận kiến thức  
         sheet_names (list, optional): Danh sách tên sheet cần xử lý. Nếu None thì xử lý tất cả
         use_multiprocessing (bool): True để dùng multiprocessing (KHUYẾN NGHỊ), False để dùng async
+        side_formats (tuple): Ghi thêm từng sheet ra data/output/sheets dưới dạng "csv" và/hoặc "parquet"
+            ngay khi sheet xong (mặc định theo RESULT_SIDE_FORMATS); output.xlsx chỉ được lưu khi kết thúc
+        resume (bool): Chạy tiếp từ nhật ký nhận xét, chỉ tạo nhận xét cho học sinh còn thiếu
     
     Returns:
-        dict: Dictionary chứa kết quả theo từng sheet
+        dict: {tên sheet: số học sinh} của các sheet đã ghi
     """
     logger.info(f"Bắt đầu xử lý file Excel với {'multiprocessing' if use_multiprocessing else 'async'}...")
 
     try:
-        # Chọn phương pháp xử lý
-        if use_multiprocessing:
-            result_dfs = processor_multiprocessing(input_file1, input_file2, sheet_names)
-        else:
-            result_dfs = processor_async(input_file1, input_file2, sheet_names)
-
-        # Lưu kết quả
-        os.makedirs("data/output", exist_ok=True)
         output_file = "data/output/output.xlsx"
 
-        with pd.ExcelWriter(output_file) as writer:
-            for sheet_name, df in result_dfs.items():
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        with StreamingResultWriter(output_file, side_output_dir="data/output/sheets", side_formats=side_formats) as writer:
+            # Chọn phương pháp xử lý
+            if use_multiprocessing:
+                sheet_rows = processor_multiprocessing(input_file1, input_file2, sheet_names, on_sheet_done=writer.write_sheet, resume=resume)
+            else:
+                sheet_rows = processor_async(input_file1, input_file2, sheet_names, on_sheet_done=writer.write_sheet, resume=resume)
 
-        logger.info(f"Kết quả đã lưu vào {output_file}")
-        return result_dfs
+        return sheet_rows
 
     except Exception as e:
         logger.error(f"Lỗi khi xử lý file: {e}")
         print(f"Error processing sheets: {e}")
         raise
 
+def processor_pipeline(input_file1, input_file2, sheet_names=None, pdf_output_folder="data/output/Tổng hợp báo cáo", side_formats=DEFAULT_SIDE_FORMATS, resume=False):
+    """
+    Chấm điểm, tạo nhận xét và tạo PDF theo dạng dây chuyền: PDF của học sinh được tạo ngay khi
+    học sinh đó có nhận xét, không chờ cả file output.xlsx
+
+    Args:
+        input_file1 (str): Đường dẫn file kết quả làm bài
+        input_file2 (str): Đường dẫn file ma trận kiến thức
+        sheet_names (list, optional): Danh sách tên sheet cần xử lý. Nếu None thì xử lý tất cả
+        pdf_output_folder (str): Thư mục gốc chứa PDF
+        side_formats (tuple): Ghi thêm từng sheet ra data/output/sheets dưới dạng "csv" và/hoặc "parquet"
+            ngay khi sheet xong (mặc định theo RESULT_SIDE_FORMATS); output.xlsx chỉ được lưu khi kết thúc
+        resume (bool): Chạy tiếp từ nhật ký nhận xét, chỉ tạo nhận xét cho học sinh còn thiếu
+
+    Returns:
+        dict: {tên sheet: số học sinh} của các sheet đã ghi
+    """
+    logger.info("Bắt đầu xử lý file Excel theo pipeline chấm điểm -> nhận xét -> PDF...")
+
+    try:
+        sheets1 = load_workbook_sheets(input_file1, sheet_names)
+        if sheet_names is None:
+            sheet_names = list(sheets1.keys())
+            logger.info(f"Tìm thấy {len(sheet_names)} sheet: {sheet_names}")
+
+        sheets2 = load_workbook_sheets(input_file2, sheet_names)
+
+        with StreamingResultWriter("data/output/output.xlsx", side_output_dir="data/output/sheets", side_formats=side_formats) as writer:
+            sheet_rows = run_pipeline(sheets1, sheets2, sheet_names, pdf_output_folder, on_sheet_done=writer.write_sheet, resume=resume)
+
+        if not sheet_rows:
+            raise ValueError("Không có sheet nào được xử lý thành công!")
+
+        return sheet_rows
+
+    except Exception as e:
+        logger.error(f"Lỗi khi xử lý file theo pipeline: {e}")
+        raise
+
 # Run the function to process all sheets
 def main():
     """Hàm main chính của hệ thống"""
@@ -271,6 +307,11 @@ def main():
             print("❌ Service Account test FAILED!")
         sys.exit(0)
     
+    # Chạy tiếp lần chạy trước: python main.py resume
+    # Tạo luôn PDF theo dạng dây chuyền: python main.py pipeline (có thể kèm resume)
+    resume = "resume" in sys.argv[1:]
+    use_pipeline = "pipeline" in sys.argv[1:]
+
     print("🚀 Bắt đầu hệ thống tạo báo cáo với Service Account...")
     
     # Kiểm tra Service Account
@@ -318,12 +359,21 @@ def main():
 
     try:
         print("⚙️ Đang xử lý với multiprocessing...")
+        if resume:
+            print("⏭️ Chạy tiếp từ nhật ký nhận xét, bỏ qua học sinh đã có nhận xét")
         
-        # Xử lý với multiprocessing (mặc định)
-        results = processor(input_file1, input_file2, use_multiprocessing=True)
+        if use_pipeline:
+            results = processor_pipeline(input_file1, input_file2, resume=resume)
+        else:
+            # Xử lý với multiprocessing (mặc định)
+            results = processor(input_file1, input_file2, use_multiprocessing=True, resume=resume)
         
         print(f"✅ Hoàn thành! Đã xử lý {len(results)} sheet")
         print("📄 Kết quả đã lưu tại: data/output/output.xlsx")
+        if DEFAULT_SIDE_FORMATS:
+            print(f"📄 Kết quả từng sheet ({', '.join(DEFAULT_SIDE_FORMATS)}): data/output/sheets")
+        if use_pipeline:
+            print("📄 PDF đã lưu tại: data/output/Tổng hợp báo cáo")
         
     except FileNotFoundError as e:
         print(f"❌ Không tìm thấy file: {e}")
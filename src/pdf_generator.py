@@ -1,12 +1,11 @@
 import os
 import re
 import pandas as pd
-from fpdf import FPDF
-from collections import Counter, defaultdict
+from report_layout import compile_layout, image, space, font, title, line, indent, paragraph, when, slot, draw_subject_tree
+from improvement_parser import improvement_source, parse_subject_entries, parse_subject_tree, parse_simple_topics
+from datetime import datetime, timezone
+from pdf_render_pool import render_parallel, render_serial, PDF_RENDER_WORKERS
 
-# print(FPDF)
-
-FONT_DIR = os.path.join(os.path.dirname(__file__), "../assets/fonts/")
 IMAGE_DIR = os.path.join(os.path.dirname(__file__), "../assets/images/")
 footer_image = os.path.join(IMAGE_DIR, "footer-image.png")
 header_image = os.path.join(IMAGE_DIR, "header-image.png")
@@ -22,180 +21,108 @@ def sanitize_filename(filename):
     """Loại bỏ ký tự đặc biệt để tránh lỗi khi tạo file."""
     return "".join(c if c.isalnum() or c in " _-" else "_" for c in filename)
 
-def check_and_add_page(pdf, lines_count, line_height=8, margin_bottom=15):
-    """Kiểm tra nếu không đủ chỗ cho n dòng nữa thì thêm trang"""
-    needed_space = lines_count * line_height
-    if pdf.get_y() + needed_space + margin_bottom > pdf.h:
-        pdf.add_page()
-
-class PDF(FPDF):
-    def footer(self):
-        self.set_y(-15) 
-        self.image(footer_image, x=0, y=282, w=215)  
-
-def pdf_generator(row, sheet_name, output_pdf):
-    pdf = FPDF()
-    pdf.add_page()
-
-    pdf.add_font("DejaVu", "", os.path.join(FONT_DIR, "DejaVuSansCondensed.ttf"), uni=True)
-    pdf.add_font("DejaVu", "B", os.path.join(FONT_DIR, "DejaVuSansCondensed-Bold.ttf"), uni=True)
-    pdf.add_font("DejaVu", "I", os.path.join(FONT_DIR, "DejaVuSansCondensed-Oblique.ttf"), uni=True)
-    pdf.add_font("DejaVu", "BI", os.path.join(FONT_DIR, "DejaVuSansCondensed-BoldOblique.ttf"), uni=True)
+def render_improvement(pdf, values):
+    """Slot "improvement": các kiến thức cần luyện tập, nhóm theo môn / chủ đề"""
+    content = improvement_source(values["row"])
+
+    if parse_subject_entries(content):
+        draw_subject_tree(pdf, parse_subject_tree(content))
+        return
+
+    for entry in parse_simple_topics(content):
+        pdf.cell(5)
+        pdf.cell(0, 8, f"• {entry.topic}:", ln=True)
+        for item in entry.contents[:3]:
+            pdf.cell(8)
+            pdf.cell(0, 8, f"◦ {item}", ln=True)
+
+
+LAYOUT = compile_layout([
+    image(header_image, x=0, y=0, w=210),
+    space(22),
+    font("B", size=13),
+    title("THÔNG BÁO"),
+    title("KẾT QUẢ THI CUỐI KỲ II NĂM HỌC 2024 - 2025"),
+    space(5),
+    font(size=11),
+    line("Họ và tên: {Họ và tên}"),
+    line("Lớp: {Lớp}"),
+    line("Môn: {subject_name}"),
+    font("BI"),
+    line("Nhà trường gửi thông báo kết quả thi như sau:", h=10, link=""),
+    indent(5),
+    font(size=11),
+    line("• Tổng số câu hỏi: {Tổng câu hỏi} câu", h=10),
+    indent(5),
+    line("• Số câu trả lời đúng: {Đúng} ({percent_correct}%)", h=10),
+    indent(5),
+    line("• Số câu trả lời sai: {Sai} ({percent_wrong}%)", h=10),
+    indent(5),
+    line("• Điểm số: {Điểm}", h=10),
+    font("B"),
+    line("1. Kết quả chi tiết cho thấy:", h=10),
+    indent(5),
+    font(size=11),
+    line("• Mức độ kiến thức cơ bản đạt được: {Mức độ kiến thức cơ bản đạt được}"),
+    indent(5),
+    line("• Mức độ kiến thức nâng cao đạt được: {Mức độ kiến thức nâng cao đạt được}"),
+    indent(5),
+    line("• Xếp hạng trong lớp: {Thứ hạng trong lớp}", h=10),
+    indent(5),
+    line("• Xếp hạng trong toàn khối: {Thứ hạng trong khối}", h=10),
+    font("B"),
+    line("2. Định hướng cải thiện và phát triển:", h=10),
+    font(size=11),
+    paragraph("{feedbacks}"),
+    space(2),
+    when("has_improvement", [
+        line("Em có thể tham khảo gợi ý luyện tập theo các kiến thức liên quan như sau:"),
+        slot("improvement"),
+    ]),
+    space(3),
+    paragraph("Chúng tôi tin rằng với sự cố gắng và nỗ lực, thí sinh {Họ và tên} sẽ tiếp tục đạt được nhiều thành tích cao hơn nữa."),
+    space(1.6),
+    paragraph("Cảm ơn sự quan tâm và hy vọng chúng tôi sẽ tiếp tục nhận được sự ủng hộ, đồng hành của Quý Phụ huynh và thí sinh trong những kỳ thi tiếp theo."),
+    image(footer_image, x=0, y=278, w=215),
+], slots={"improvement": render_improvement})
+
+def report_fields(row, sheet_name):
+    """Các giá trị tính thêm cho LAYOUT"""
+    match = re.match(r"(.+?)\s+Khối\s+\d+", sheet_name)
 
-    pdf.image(header_image , x=0, y=0, w=210)
-    pdf.ln(22)
+    return {
+        "subject_name": match.group(1) if match else sheet_name,
+        "percent_correct": round((row['Đúng'] / row['Tổng câu hỏi']) * 100),
+        "percent_wrong": round((row['Sai'] / row['Tổng câu hỏi']) * 100),
+        "has_improvement": isinstance(row['Nội dung cần cải thiện'], str) and bool(row['Nội dung cần cải thiện'].strip()),
+        "feedbacks": re.sub(r'\n\s*\n', '\n', str(row['Nhận xét'])).strip(),
+    }
 
+def pdf_generator(row, sheet_name, output_pdf, creation_date=None):
     # Lấy thông tin từ dòng dữ liệu
     student_name = sanitize_filename(str(row["Họ và tên"]).strip())
     class_name = sanitize_filename(str(row["Lớp"]).strip())
-    match = re.match(r"(.+?)\s+Khối\s+\d+", sheet_name)
-    subject_name = match.group(1) if match else sheet_name
 
     # Đặt tên file PDF theo format: Lớp_Họ và tên_Môn.pdf
     pdf_filename = f"{class_name}_{student_name}_{sheet_name}.pdf"
     pdf_path = os.path.join(output_pdf, pdf_filename)
 
-    percent_correct = round((row['Đúng'] / row['Tổng câu hỏi']) * 100)
-    percent_wrong = round((row['Sai'] / row['Tổng câu hỏi']) * 100)
-
-    pdf.set_font("DejaVu", "B", size=13)
-    pdf.cell(200, 10, "THÔNG BÁO", ln=True, align="C")
-    pdf.cell(200, 10, "KẾT QUẢ THI CUỐI KỲ II NĂM HỌC 2024 - 2025", ln=True, align="C")
-    pdf.ln(5)
-    pdf.set_font("DejaVu", size=11)
-    pdf.cell(0, 8, f"Họ và tên: {row['Họ và tên']}", ln=True)
-    pdf.cell(0, 8, f"Lớp: {row['Lớp']}", ln=True)
-    pdf.cell(0, 8, f"Môn: {subject_name}", ln=True)
-    pdf.set_font("DejaVu", style="BI")
-    pdf.cell(0, 10, "Nhà trường gửi thông báo kết quả thi như sau:", ln=True, link="")
-    pdf.cell(5)
-    pdf.set_font("DejaVu", size=11)
-    pdf.cell(0, 10, f"• Tổng số câu hỏi: {row['Tổng câu hỏi']} câu", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 10, f"• Số câu trả lời đúng: {row['Đúng']} ({percent_correct}%)", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 10, f"• Số câu trả lời sai: {row['Sai']} ({percent_wrong}%)", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 10, f"• Điểm số: {row['Điểm']}", ln=True)
-    pdf.set_font("DejaVu", style="B")
-    pdf.cell(0, 10, "1. Kết quả chi tiết cho thấy:", ln=True)
-    pdf.cell(5)
-    pdf.set_font("DejaVu", size=11)
-    pdf.cell(0, 8, f"• Mức độ kiến thức cơ bản đạt được: {row['Mức độ kiến thức cơ bản đạt được']}", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 8, f"• Mức độ kiến thức nâng cao đạt được: {row['Mức độ kiến thức nâng cao đạt được']}", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 10, f"• Xếp hạng trong lớp: {row['Thứ hạng trong lớp']}", ln=True)
-    pdf.cell(5)
-    pdf.cell(0, 10, f"• Xếp hạng trong toàn khối: {row['Thứ hạng trong khối']}", ln=True)
-    pdf.set_font("DejaVu", style="B")
-    pdf.cell(0, 10, "2. Định hướng cải thiện và phát triển:", ln=True)
-    pdf.set_font("DejaVu", size=11)
-
-    feedbacks = re.sub(r'\n\s*\n', '\n', str(row['Nhận xét'])).strip()
-    pdf.multi_cell(0, 8, feedbacks, ln=True)
-    pdf.ln(2)
-
-    if isinstance(row['Nội dung cần cải thiện'], str) and row['Nội dung cần cải thiện'].strip():
-        pdf.cell(0, 8, f"Em có thể tham khảo gợi ý luyện tập theo các kiến thức liên quan như sau:", ln=True)
-
-        topics = row['Nội dung cần cải thiện'].split(";")
-        topics = [t.strip() for t in topics if t.strip()]
-
-        has_subject = any(re.match(r"(.+?)\s*-\s*(.+?):\s*(.+)", t) for t in topics)
-
-        if has_subject:
-            pdf_structure = {}
-            topic_counts = {}
-
-            for topic_data in topics:
-                match = re.match(r"(.+?)\s*-\s*(.+?):\s*(.+)", topic_data)
-                if match:
-                    subject, topic, content_list = match.groups()
-                    subject = subject.strip()
-                    topic = topic.strip()
-                    contents = [c.strip() for c in content_list.split(" - ")][:2]  # Tối đa 2 bài
-
-                    # Khởi tạo nếu môn chưa có
-                    if subject not in pdf_structure:
-                        pdf_structure[subject] = {}
-                        topic_counts[subject] = 0
-
-                    # Bỏ qua nếu đã đủ 4 topic
-                    if topic_counts[subject] >= 4:
-                        continue
-
-                    # Bỏ qua nếu topic đã tồn tại
-                    if topic in pdf_structure[subject]:
-                        continue
-
-                    # Ghi nhận topic và tăng đếm
-                    pdf_structure[subject][topic] = contents
-                    topic_counts[subject] += 1
-
-            # In theo thứ tự ưu tiên nếu có, rồi đến các môn còn lại
-            subject_priority = ["Toán", "Ngữ Văn", "Tiếng Anh"]
-            printed_subjects = set()
-
-            for subject in subject_priority:
-                if subject in pdf_structure:
-                    pdf.set_font("DejaVu", style="I")
-                    pdf.cell(0, 8, f"- {subject}", ln=True)
-                    pdf.set_font("DejaVu", size=11)
-                    for topic, lessons in pdf_structure[subject].items():
-                        lines_needed = 1 + len(lessons)
-                        check_and_add_page(pdf, lines_count=lines_needed)
-
-                        pdf.cell(8)
-                        pdf.cell(0, 8, f"• {topic}:", ln=True)
-                        for lesson in lessons:
-                            pdf.cell(16)
-                            pdf.cell(0, 8, f"◦ {lesson}", ln=True)
-                    printed_subjects.add(subject)
-
-            # In các môn còn lại (ngoài danh sách ưu tiên)
-            for subject in pdf_structure:
-                if subject not in printed_subjects:
-                    pdf.set_font("DejaVu", style="I")
-                    pdf.cell(0, 8, f"- {subject}", ln=True)
-                    pdf.set_font("DejaVu", size=11)
-                    for topic, lessons in pdf_structure[subject].items():
-                        lines_needed = 1 + len(lessons)
-                        check_and_add_page(pdf, lines_count=lines_needed)
-
-                        pdf.cell(8)
-                        pdf.cell(0, 8, f"• {topic}:", ln=True)
-                        for lesson in lessons:
-                            pdf.cell(16)
-                            pdf.cell(0, 8, f"◦ {lesson}", ln=True)
-
-        else:
-            for topic_data in topics:
-                match = re.match(r"(.+?):\s*(.+)", topic_data)
-                if match:
-                    topic, content_list = match.groups()
-                    topic = topic.strip()
-                    contents = [c.strip() for c in content_list.split(" - ")][:3]
-
-                    pdf.cell(5)
-                    pdf.cell(0, 8, f"• {topic}:", ln=True)
-                    for content in contents:
-                        pdf.cell(8)
-                        pdf.cell(0, 8, f"◦ {content}", ln=True)
-
-    pdf.ln(3)
-    pdf.multi_cell(0, 8, f"Chúng tôi tin rằng với sự cố gắng và nỗ lực, thí sinh {row['Họ và tên']} sẽ tiếp tục đạt được nhiều thành tích cao hơn nữa.", ln=True)
-    pdf.ln(1.6)
-    pdf.multi_cell(0, 8, "Cảm ơn sự quan tâm và hy vọng chúng tôi sẽ tiếp tục nhận được sự ủng hộ, đồng hành của Quý Phụ huynh và thí sinh trong những kỳ thi tiếp theo.", ln=True)
-
-    pdf.image(footer_image , x=0, y=278, w=215)
-
-    pdf.output(pdf_path)
-
-def process_excel(input_file, output_folder):
-    """Hàm xử lý file Excel và tạo các file PDF"""
+    LAYOUT.render_to_file(row, report_fields(row, sheet_name), pdf_path, creation_date=creation_date)
+
+def render_student_pdf(row, sheet_name, output_folder, creation_date=None):
+    """Tạo PDF cho một học sinh trong thư mục theo môn và lớp"""
+    class_name = str(row["Lớp"]).strip()
+    sheet_output_folder = os.path.join(output_folder, sheet_name, f"Lớp {class_name}")
+    os.makedirs(sheet_output_folder, exist_ok=True)
+
+    # Tạo PDF cho từng học sinh
+    pdf_generator(row, sheet_name, sheet_output_folder, creation_date=creation_date)
+
+def process_excel(input_file, output_folder, workers=PDF_RENDER_WORKERS):
+    """Hàm xử lý file Excel và tạo các file PDF (workers > 1: tạo song song trên process pool)"""
     # Đọc tất cả các sheet trong file Excel
     xls = pd.ExcelFile(input_file)
+    jobs = []
 
     for sheet_name in xls.sheet_names:
         df = pd.read_excel(xls, sheet_name)
@@ -206,12 +133,14 @@ def process_excel(input_file, output_folder):
 
         # Xử lý từng học sinh
         for _, row in df.iterrows():
-            class_name = str(row["Lớp"]).strip()
-            sheet_output_folder = os.path.join(output_folder, sheet_name, f"Lớp {class_name}")
-            os.makedirs(sheet_output_folder, exist_ok=True)
-
-            # Tạo PDF cho từng học sinh
-            pdf_generator(row, sheet_name, sheet_output_folder)
+            jobs.append((row, sheet_name, output_folder))
+
+    # Cùng một ngày tạo cho cả lần chạy: PDF song song giống hệt PDF tạo tuần tự
+    creation_date = datetime.now(timezone.utc)
+    if workers > 1:
+        render_parallel(render_student_pdf, jobs, workers=workers, creation_date=creation_date)
+    else:
+        render_serial(render_student_pdf, jobs, creation_date=creation_date)
 
 
 # Gọi hàm xử lý file Excel
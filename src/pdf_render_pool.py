@@ -0,0 +1,65 @@
+import os
+import time
+import multiprocessing as mp
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logger_config import logger
+
+# Số tiến trình tạo PDF và số học sinh mỗi lần gửi cho worker (gộp để giảm chi phí IPC)
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", mp.cpu_count()))
+PDF_RENDER_CHUNK_SIZE = int(os.getenv("PDF_RENDER_CHUNK_SIZE", 50))
+
+
+def _render_chunk(render_fn, jobs, creation_date):
+    """Tạo PDF cho một nhóm học sinh trong worker, file được ghi ngay trong worker"""
+    started = time.time()
+    for row, sheet_name, output_folder in jobs:
+        render_fn(row, sheet_name, output_folder, creation_date=creation_date)
+    return os.getpid(), len(jobs), time.time() - started
+
+
+def render_serial(render_fn, jobs, creation_date=None):
+    """Tạo PDF lần lượt trong tiến trình hiện tại"""
+    for row, sheet_name, output_folder in jobs:
+        render_fn(row, sheet_name, output_folder, creation_date=creation_date)
+
+
+def render_parallel(render_fn, jobs, workers=PDF_RENDER_WORKERS, chunk_size=PDF_RENDER_CHUNK_SIZE, creation_date=None):
+    """
+    Chia các học sinh thành từng nhóm chunk_size và tạo PDF song song trên process pool
+
+    Args:
+        render_fn (callable): Hàm module-level render_fn(row, sheet_name, output_folder, creation_date=...)
+        jobs (list): Danh sách (row, sheet_name, output_folder)
+        workers (int): Số tiến trình
+        chunk_size (int): Số học sinh mỗi lần gửi cho worker
+        creation_date (datetime, optional): Ngày tạo ghi vào PDF (giống nhau thì file giống hệt bản chạy tuần tự)
+
+    Returns:
+        dict: {pid: {"pdfs": số PDF, "seconds": thời gian render}}
+    """
+    chunk_size = max(1, chunk_size)
+    chunks = [jobs[start:start + chunk_size] for start in range(0, len(jobs), chunk_size)]
+    workers = max(1, min(workers, len(chunks)))
+    worker_stats = defaultdict(lambda: {"pdfs": 0, "seconds": 0.0})
+
+    logger.info(f"🖨️ Tạo {len(jobs)} PDF với {workers} tiến trình ({len(chunks)} nhóm x {chunk_size} học sinh)")
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_render_chunk, render_fn, chunk, creation_date) for chunk in chunks]
+        done_pdfs = 0
+        for future in as_completed(futures):
+            pid, count, seconds = future.result()
+            worker_stats[pid]["pdfs"] += count
+            worker_stats[pid]["seconds"] += seconds
+            done_pdfs += count
+            logger.info(f"📈 Đã tạo {done_pdfs}/{len(jobs)} PDF ({done_pdfs / (time.time() - start_time):.1f} PDF/s)")
+
+    elapsed = time.time() - start_time
+    for pid, stats in sorted(worker_stats.items()):
+        throughput = stats["pdfs"] / stats["seconds"] if stats["seconds"] > 0 else 0
+        logger.info(f"   🧵 Tiến trình {pid}: {stats['pdfs']} PDF trong {stats['seconds']:.1f}s ({throughput:.1f} PDF/s)")
+    logger.info(f"✅ Tạo {len(jobs)} PDF trong {elapsed:.1f}s ({len(jobs) / elapsed if elapsed > 0 else 0:.1f} PDF/s)")
+
+    return dict(worker_stats)
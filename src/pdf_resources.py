@@ -0,0 +1,141 @@
+import io
+import os
+import copy
+from collections import namedtuple
+from fontTools import ttLib
+from fontTools import subset as ftsubset
+from fpdf import FPDF
+# Dùng cấu trúc nội bộ của fpdf2 (TTFFont, ImageCache...): phiên bản được ghim trong requirements.txt
+from fpdf.fonts import TTFFont, SubsetMap
+from fpdf.image_datastructures import ImageCache
+from fpdf.image_parsing import preload_image
+
+# Bốn kiểu chữ DejaVu dùng trong các báo cáo PDF
+DEJAVU_FACES = (
+    ("", "DejaVuSansCondensed.ttf"),
+    ("B", "DejaVuSansCondensed-Bold.ttf"),
+    ("I", "DejaVuSansCondensed-Oblique.ttf"),
+    ("BI", "DejaVuSansCondensed-BoldOblique.ttf"),
+)
+
+# Các dải ký tự dùng trong báo cáo: Latin, tiếng Việt, dấu câu và ký hiệu thường gặp
+WORKING_SET_RANGES = (
+    (0x0020, 0x024F),  # Basic Latin, Latin-1, Latin Extended-A/B (ơ, ư)
+    (0x0300, 0x036F),  # Dấu thanh dạng tổ hợp
+    (0x1E00, 0x1EFF),  # Latin Extended Additional (ạ, ế, ữ, ...)
+    (0x2000, 0x206F),  # Dấu câu: –, “ ”, •, …
+    (0x20A0, 0x20CF),  # Ký hiệu tiền tệ
+    (0x25A0, 0x25FF),  # Hình học (◦, ■)
+)
+
+# Cache trong tiến trình hiện tại: font đã phân tích (metrics, cmap, độ rộng ký tự), font rút gọn theo
+# WORKING_SET_RANGES và ảnh đã giải mã. Mỗi PDF mới chỉ nhận bản sao nhẹ, không phải đọc lại file.
+_font_templates = {}
+_image_infos = {}
+
+FontTemplate = namedtuple("FontTemplate", ["font", "working_data", "working_glyphs"])
+
+
+def _load_font(family, style, font_path):
+    """Font đầy đủ giống hệt fpdf tạo ra trong add_font (kể cả glyph .notdef bổ sung nếu font thiếu)"""
+    scratch = FPDF()
+    scratch.add_font(family, style, font_path)
+    return scratch.fonts[f"{family.lower()}{style}"]
+
+
+def _font_template(family, style, font_path):
+    key = (os.path.abspath(font_path), family.lower(), style)
+    template = _font_templates.get(key)
+    if template is None:
+        font = _load_font(family, style, font_path)
+
+        # fpdf2 subset font ngay khi output, chi phí tỉ lệ với số glyph của font (DejaVu ~6000 glyph).
+        # Rút gọn trước một lần về các glyph có thể dùng trong báo cáo; subset cuối cùng vẫn ra cùng kết quả
+        working_ttfont = _load_font(family, style, font_path).ttfont
+        working_glyphs = {
+            glyph_name for unicode, glyph_name in font.cmap.items()
+            if any(start <= unicode <= end for start, end in WORKING_SET_RANGES)
+        }
+        options = ftsubset.Options(notdef_outline=True, recommended_glyphs=True, glyph_names=True)
+        options.drop_tables += ["FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta"]  # fpdf2 cũng bỏ các bảng này
+        subsetter = ftsubset.Subsetter(options)
+        subsetter.populate(glyphs=working_glyphs)
+        subsetter.subset(working_ttfont)
+        output = io.BytesIO()
+        working_ttfont.save(output)
+
+        template = _font_templates[key] = FontTemplate(font, output.getvalue(), frozenset(working_ttfont.getGlyphOrder()))
+    return template
+
+
+class _WorkingSetSubsetMap(SubsetMap):
+    """SubsetMap chuyển sang font đầy đủ khi PDF dùng glyph nằm ngoài font rút gọn"""
+
+    def __init__(self, font, template, font_args):
+        self.working_glyphs = template.working_glyphs
+        self.font_args = font_args
+        super().__init__(font)
+
+    def pick_glyph(self, glyph):
+        if glyph is not None and self.font_args is not None and glyph.glyph_name not in self.working_glyphs:
+            self.font.ttfont = _load_font(*self.font_args).ttfont
+            self.font_args = None
+        return super().pick_glyph(glyph)
+
+
+def add_cached_font(pdf, family, style, font_path):
+    """
+    Tương đương pdf.add_font(family, style, font_path) nhưng dùng lại font đã phân tích trong tiến trình.
+    Metrics, cmap và độ rộng ký tự được dùng chung; mỗi PDF có TTFont (rút gọn) và bảng subset riêng
+    vì fpdf2 subset TTFont ngay trên object khi output.
+    """
+    style = "".join(sorted(style.upper()))
+    fontkey = f"{family.lower()}{style}"
+    if fontkey in pdf.fonts:
+        return
+
+    template = _font_template(family, style, font_path)
+
+    font = TTFFont.__new__(TTFFont)
+    for slot in TTFFont.__slots__:
+        if hasattr(template.font, slot):
+            setattr(font, slot, getattr(template.font, slot))
+    font.i = len(pdf.fonts) + 1
+    font.ttfont = ttLib.TTFont(io.BytesIO(template.working_data), recalcTimestamp=False, lazy=True)
+    font.desc = copy.copy(template.font.desc)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font.subset = _WorkingSetSubsetMap(font, template, (family, style, font_path))
+    pdf.fonts[fontkey] = font
+
+
+def add_dejavu_fonts(pdf, font_dir, family="DejaVu"):
+    """Thêm 4 kiểu chữ DejaVu (thường, đậm, nghiêng, đậm nghiêng) từ cache font"""
+    for style, file_name in DEJAVU_FACES:
+        add_cached_font(pdf, family, style, os.path.join(font_dir, file_name))
+
+
+def cached_image(pdf, image_path, **kwargs):
+    """
+    Tương đương pdf.image(image_path, ...) nhưng ảnh chỉ được đọc và giải mã một lần mỗi tiến trình;
+    các PDF sau dùng lại dữ liệu XObject đã giải mã
+    """
+    image_cache = pdf.image_cache
+    if image_path not in image_cache.images:
+        key = (os.path.abspath(image_path), image_cache.image_filter)
+        cached = _image_infos.get(key)
+        if cached is None:
+            scratch = ImageCache(image_filter=image_cache.image_filter)
+            _, _, info = preload_image(scratch, image_path)
+            icc_profiles = {index: profile for profile, index in scratch.icc_profiles.items()}
+            cached = _image_infos[key] = (info, icc_profiles.get(info.get("iccp_i")))
+
+        info, iccp = cached
+        doc_info = copy.copy(info)
+        doc_info["i"] = len(image_cache.images) + 1
+        doc_info["usages"] = 0
+        if iccp is not None:
+            doc_info["iccp_i"] = image_cache.icc_profiles.setdefault(iccp, len(image_cache.icc_profiles))
+        image_cache.images[image_path] = doc_info
+
+    return pdf.image(image_path, **kwargs)
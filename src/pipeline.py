@@ -0,0 +1,259 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logger_config import logger
+from data_processor_module4 import handle_sheet
+from feedback_journal import feedback_journal
+from rate_limiter import get_rate_limiter, init_worker_rate_limiter
+from service_account_processor import (
+    sa_processor, generate_feedback_service_account, collect_feedback_tasks,
+    get_feedback_process_count, error_fallback_comment,
+)
+from pdf_generator_Bebras import render_student_pdf
+
+# Kích thước hàng đợi giữa các stage: stage sau chậm thì stage trước phải chờ (backpressure)
+FEEDBACK_QUEUE_SIZE = int(os.getenv("PIPELINE_FEEDBACK_QUEUE_SIZE", 200))
+PDF_QUEUE_SIZE = int(os.getenv("PIPELINE_PDF_QUEUE_SIZE", 100))
+PDF_WORKERS = int(os.getenv("PIPELINE_PDF_WORKERS", max(1, mp.cpu_count() - 1)))
+
+_STOP = None
+
+
+def _noop():
+    return None
+
+
+def start_workers(executor, workers):
+    """
+    Tạo sẵn tiến trình con của executor và chờ chúng chạy. Phải gọi trước khi các thread của stage chạy:
+    fork khi tiến trình chính đã có thread đang giữ khóa (logging, stderr) có thể làm tiến trình con bị treo.
+    """
+    for future in [executor.submit(_noop) for _ in range(workers)]:
+        future.result()
+
+
+class PipelineStage:
+    """
+    Một stage của pipeline: các thread lấy việc từ hàng đợi vào, xử lý, rồi đẩy kết quả sang hàng đợi
+    của stage sau. Khi tất cả thread nhận tín hiệu dừng thì stage gửi tín hiệu dừng cho stage sau.
+    """
+
+    def __init__(self, name, handle, workers, input_queue, output_queue=None, downstream=None):
+        self.name = name
+        self.handle = handle
+        self.workers = workers
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.downstream = downstream
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self.first_output_at = None
+        self._running = workers
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def put(self, item):
+        """Đưa việc vào stage (chặn khi hàng đợi đầy)"""
+        self.input_queue.put(item)
+
+    def stop(self):
+        """Báo không còn việc mới: mỗi thread nhận một tín hiệu dừng"""
+        for _ in range(self.workers):
+            self.input_queue.put(_STOP)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is _STOP:
+                break
+
+            started = time.time()
+            try:
+                result = self.handle(item)
+            except Exception as e:
+                logger.error(f"❌ Stage {self.name}: lỗi khi xử lý {item!r:.80}: {e}")
+                with self.lock:
+                    self.failed += 1
+                continue
+            finished = time.time()
+
+            if result is not None and self.downstream is not None:
+                self.downstream.put(result)
+
+            with self.lock:
+                self.processed += 1
+                self.busy_time += finished - started
+                self.blocked_time += time.time() - finished
+                if self.first_output_at is None:
+                    self.first_output_at = finished
+
+        with self.lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.downstream is not None:
+            self.downstream.stop()
+
+    def get_stats(self, start_time):
+        with self.lock:
+            return {
+                "processed": self.processed,
+                "failed": self.failed,
+                "busy_seconds": round(self.busy_time, 1),
+                "blocked_seconds": round(self.blocked_time, 1),
+                "first_output_after": round(self.first_output_at - start_time, 1) if self.first_output_at else None,
+            }
+
+
+def run_pipeline(sheets1, sheets2, sheet_names, pdf_output_folder, on_sheet_done=None, resume=False):
+    """
+    Chấm điểm -> nhận xét -> PDF theo dạng dây chuyền: học sinh của sheet chấm xong được đưa ngay vào
+    hàng đợi nhận xét, học sinh có nhận xét được đưa ngay sang hàng đợi tạo PDF. Các hàng đợi có giới hạn
+    nên stage nhanh sẽ chờ stage chậm, tổng thời gian gần với thời gian của stage chậm nhất.
+
+    Args:
+        sheets1 (dict): {tên sheet: DataFrame kết quả làm bài}
+        sheets2 (dict): {tên sheet: DataFrame ma trận kiến thức}
+        sheet_names (list): Thứ tự các sheet cần xử lý
+        pdf_output_folder (str): Thư mục gốc chứa PDF của học sinh
+        on_sheet_done (callable, optional): Gọi on_sheet_done(sheet_name, df) khi cả sheet đã có nhận xét
+        resume (bool): Bỏ qua các học sinh đã có nhận xét trong nhật ký
+
+    Returns:
+        dict: {tên sheet: số học sinh} theo thứ tự sheet_names
+    """
+    jobs = [sheet_name for sheet_name in sheet_names if sheet_name in sheets1 and sheet_name in sheets2]
+    for sheet_name in sheet_names:
+        if sheet_name not in jobs:
+            logger.warning(f"⚠️ Sheet {sheet_name} không có đủ dữ liệu ở 2 file, bỏ qua")
+
+    use_feedback = sa_processor.service_account_creds is not None
+    if not use_feedback:
+        logger.error("❌ Không có Service Account credentials, tạo PDF không có nhận xét")
+
+    grading_workers = max(1, min(len(jobs), mp.cpu_count() // 2))
+    feedback_workers = get_feedback_process_count()
+    pdf_workers = max(1, PDF_WORKERS)
+    logger.info(f"🔧 Pipeline: chấm điểm {grading_workers} tiến trình, nhận xét {feedback_workers} tiến trình, "
+                f"PDF {pdf_workers} tiến trình (hàng đợi {FEEDBACK_QUEUE_SIZE}/{PDF_QUEUE_SIZE})")
+
+    result_dfs = {}
+    sheet_rows = {}
+    pending_feedbacks = {}
+    sheet_lock = threading.Lock()
+    start_time = time.time()
+
+    def finish_sheet(sheet_name):
+        # Gọi dưới sheet_lock: ghi sheet và giải phóng DataFrame
+        df = result_dfs.pop(sheet_name)
+        sheet_rows[sheet_name] = len(df)
+        if on_sheet_done is not None:
+            on_sheet_done(sheet_name, df)
+        logger.info(f"✅ Sheet {sheet_name}: đã có nhận xét cho {len(df)} học sinh")
+
+    def student_row(sheet_name, index):
+        return sheet_name, result_dfs[sheet_name].loc[index].copy()
+
+    with ProcessPoolExecutor(max_workers=grading_workers) as grading_executor, \
+            ProcessPoolExecutor(max_workers=feedback_workers, initializer=init_worker_rate_limiter,
+                                initargs=(get_rate_limiter(),)) as feedback_executor, \
+            ProcessPoolExecutor(max_workers=pdf_workers) as pdf_executor:
+
+        def generate_feedback(item):
+            sheet_name, index, task_args = item
+            try:
+                student_name, feedback, is_fallback = feedback_executor.submit(generate_feedback_service_account, task_args).result()
+            except Exception as e:
+                logger.error(f"❌ Lỗi khi xử lý nhận xét cho {task_args[0]} (sheet {sheet_name}): {e}")
+                feedback, is_fallback = error_fallback_comment(task_args[0]), True
+
+            if not is_fallback:
+                try:
+                    feedback_journal.record(sheet_name, index, task_args, feedback)
+                except Exception as e:
+                    # Lỗi nhật ký chỉ làm mất khả năng chạy tiếp, không được làm mất nhận xét của học sinh
+                    logger.error(f"❌ Lỗi khi ghi nhật ký nhận xét cho {task_args[0]} (sheet {sheet_name}): {e}")
+
+            with sheet_lock:
+                result_dfs[sheet_name].at[index, "Nhận xét"] = feedback
+                row = student_row(sheet_name, index)
+                pending_feedbacks[sheet_name] -= 1
+                if pending_feedbacks[sheet_name] == 0:
+                    finish_sheet(sheet_name)
+            return row
+
+        def render_pdf(item):
+            sheet_name, row = item
+            pdf_executor.submit(render_student_pdf, row, sheet_name, pdf_output_folder).result()
+
+        for executor, workers in ((grading_executor, grading_workers), (feedback_executor, feedback_workers),
+                                  (pdf_executor, pdf_workers)):
+            start_workers(executor, workers)
+
+        pdf_stage = PipelineStage("pdf", render_pdf, pdf_workers, queue.Queue(maxsize=PDF_QUEUE_SIZE)).start()
+        feedback_stage = PipelineStage("feedback", generate_feedback, feedback_workers,
+                                       queue.Queue(maxsize=FEEDBACK_QUEUE_SIZE), downstream=pdf_stage).start()
+
+        grading_futures = {
+            grading_executor.submit(handle_sheet, sheets1[sheet_name], sheets2[sheet_name]): sheet_name
+            for sheet_name in jobs
+        }
+
+        try:
+            for future in as_completed(grading_futures):
+                sheet_name = grading_futures[future]
+                try:
+                    result = future.result()
+                except Exception as sheet_error:
+                    logger.error(f"❌ Lỗi xử lý sheet {sheet_name}: {sheet_error}")
+                    continue
+
+                logger.info(f"📊 Sheet {sheet_name}: đã chấm {len(result)} học sinh ({time.time() - start_time:.1f}s)")
+                if "Nhận xét" not in result.columns:
+                    result["Nhận xét"] = ""
+
+                tasks = collect_feedback_tasks(result) if use_feedback else []
+                if resume:
+                    tasks, saved_comments = feedback_journal.split_completed(sheet_name, tasks)
+                    for index, comment in saved_comments.items():
+                        result.at[index, "Nhận xét"] = comment
+
+                task_indexes = {index for index, _ in tasks}
+                ready = [index for index in result.index if index not in task_indexes]
+
+                with sheet_lock:
+                    result_dfs[sheet_name] = result
+                    pending_feedbacks[sheet_name] = len(tasks)
+                    ready_rows = [student_row(sheet_name, index) for index in ready]
+                    if not tasks:
+                        finish_sheet(sheet_name)
+
+                # Học sinh không cần gọi Gemini đi thẳng sang stage PDF
+                for item in ready_rows:
+                    pdf_stage.put(item)
+                for index, task_args in tasks:
+                    feedback_stage.put((sheet_name, index, task_args))
+        finally:
+            feedback_stage.stop()
+            feedback_stage.join()
+            pdf_stage.join()
+
+    elapsed = time.time() - start_time
+    logger.info(f"🎯 Pipeline hoàn thành {len(sheet_rows)}/{len(sheet_names)} sheet trong {elapsed:.1f}s")
+    logger.info(f"📈 Stage nhận xét: {feedback_stage.get_stats(start_time)}")
+    logger.info(f"📈 Stage PDF: {pdf_stage.get_stats(start_time)}")
+
+    return {sheet_name: sheet_rows[sheet_name] for sheet_name in sheet_names if sheet_name in sheet_rows}
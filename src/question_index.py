@@ -0,0 +1,92 @@
+import numbers
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+BASIC_LEVELS = ["NB", "TH", "NBT"]
+ADVANCED_LEVELS = ["VD", "VDT", "VDC"]
+
+# Các cột thông tin của một câu hỏi trong sheet ma trận
+METADATA_COLUMNS = {
+    "subject": "Môn",
+    "topic": "Chủ đề",
+    "chapter": "Chương",
+    "lesson": "Bài",
+    "link": "Link bài luyện",
+    "detail": "Chi tiết",
+}
+
+QuestionInfo = namedtuple("QuestionInfo", ["level", "subject", "topic", "chapter", "lesson", "link", "detail"])
+
+
+def normalize_cell(value):
+    """Chuẩn hóa giá trị ô: NaN -> "", số thực -> chuỗi"""
+    if isinstance(value, float):
+        return "" if pd.isna(value) else str(value)
+    return value
+
+
+def question_key(value):
+    """Chuyển giá trị cột "Câu hỏi" thành số nguyên (None nếu không phải số câu hợp lệ)"""
+    if isinstance(value, bool) or not isinstance(value, numbers.Number):
+        return None
+    if pd.isna(value) or not float(value).is_integer():
+        return None
+    return int(value)
+
+
+class QuestionIndex:
+    """
+    Chỉ mục câu hỏi -> thông tin ma trận (cấp độ, Môn/Chủ đề/Chương/Bài/Link/Chi tiết),
+    xây dựng một lần cho mỗi sheet để tra cứu O(1)
+    """
+
+    def __init__(self, df2):
+        self.has_subject = "Môn" in df2.columns
+        self.total_basic = (df2["Cấp độ nhận thức"].isin(BASIC_LEVELS)).sum()
+        self.total_advanced = (df2["Cấp độ nhận thức"].isin(ADVANCED_LEVELS)).sum()
+        self.questions = {}
+
+        n_rows = len(df2)
+        columns = {
+            field: df2[column].tolist() if column in df2.columns else [""] * n_rows
+            for field, column in METADATA_COLUMNS.items()
+        }
+        levels = df2["Cấp độ nhận thức"].tolist()
+
+        for row_idx, value in enumerate(df2["Câu hỏi"].tolist()):
+            key = question_key(value)
+            # Giữ dòng đầu tiên nếu một câu hỏi xuất hiện nhiều lần trong ma trận
+            if key is None or key in self.questions:
+                continue
+
+            self.questions[key] = QuestionInfo(
+                level=levels[row_idx],
+                **{field: normalize_cell(values[row_idx]) for field, values in columns.items()}
+            )
+
+    def get(self, question_num):
+        """Lấy thông tin câu hỏi theo số thứ tự (None nếu không có trong ma trận)"""
+        return self.questions.get(question_num)
+
+    def __contains__(self, question_num):
+        return question_num in self.questions
+
+    def __len__(self):
+        return len(self.questions)
+
+    def level_masks(self, n_questions):
+        """Mask cơ bản/nâng cao theo thứ tự câu hỏi (câu 1..n)"""
+        basic_mask = np.zeros(n_questions, dtype=bool)
+        advanced_mask = np.zeros(n_questions, dtype=bool)
+
+        for i in range(n_questions):
+            info = self.questions.get(i + 1)
+            if info is None:
+                continue
+            if info.level in BASIC_LEVELS:
+                basic_mask[i] = True
+            elif info.level in ADVANCED_LEVELS:
+                advanced_mask[i] = True
+
+        return basic_mask, advanced_mask
@@ -0,0 +1,86 @@
+import os
+import math
+import time
+import multiprocessing as mp
+from logger_config import logger
+
+# Giới hạn request/phút của Service Account (theo quota thực tế của project)
+SERVICE_ACCOUNT_RPM = int(os.getenv("SERVICE_ACCOUNT_RPM", 60))
+
+
+class TokenBucket:
+    """
+    Token bucket dùng chung giữa các tiến trình (shared memory + lock).
+    Mỗi request lấy trước một token; nếu bucket đã hết, request được xếp lượt
+    và nhận về thời gian cần chờ thay vì ngủ một khoảng cố định.
+    """
+
+    def __init__(self, requests_per_minute=SERVICE_ACCOUNT_RPM, burst=None):
+        self.requests_per_minute = requests_per_minute
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1, requests_per_minute // 10))
+        self.lock = mp.Lock()
+        self.tokens = mp.Value("d", self.capacity, lock=False)
+        self.updated_at = mp.Value("d", time.monotonic(), lock=False)
+        self.blocked_until = mp.Value("d", 0.0, lock=False)
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self.updated_at.value)
+        self.tokens.value = min(self.capacity, self.tokens.value + elapsed * self.rate)
+        self.updated_at.value = now
+
+    def acquire(self):
+        """
+        Giữ chỗ một request
+
+        Returns:
+            float: Số giây cần chờ trước khi gửi request (0 nếu gửi được ngay)
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens.value -= 1
+            wait = -self.tokens.value / self.rate if self.tokens.value < 0 else 0.0
+            return max(wait, self.blocked_until.value - now)
+
+    def wait(self):
+        """Giữ chỗ một request và chờ đến lượt, trả về số giây đã chờ"""
+        delay = self.acquire()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def penalize(self, delay):
+        """Tạm dừng mọi tiến trình trong delay giây (khi server trả về 429)"""
+        with self.lock:
+            self.blocked_until.value = max(self.blocked_until.value, time.monotonic() + delay)
+        logger.warning(f"⏸️ Tạm dừng gửi request {delay:.1f}s do rate limit")
+
+    def get_stats(self):
+        """Lấy thống kê"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'requests_per_minute': self.requests_per_minute,
+                'available_tokens': round(max(0.0, self.tokens.value), 2),
+                'queued_requests': max(0, math.ceil(-self.tokens.value)),
+                'blocked_for': round(max(0.0, self.blocked_until.value - now), 1)
+            }
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Token bucket của tiến trình hiện tại (bucket dùng chung nếu đã được truyền qua initializer)"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = TokenBucket()
+    return _rate_limiter
+
+
+def init_worker_rate_limiter(rate_limiter):
+    """Initializer cho ProcessPoolExecutor: dùng token bucket của tiến trình chính"""
+    global _rate_limiter
+    _rate_limiter = rate_limiter
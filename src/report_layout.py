@@ -0,0 +1,241 @@
+import os
+import string
+from collections import namedtuple, ChainMap
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+from pdf_resources import add_dejavu_fonts, cached_image
+
+FONT_DIR = os.path.join(os.path.dirname(__file__), "../assets/fonts/")
+FONT_FAMILY = "DejaVu"
+
+# Một thao tác trong định nghĩa báo cáo; text có thể chứa trường {Tên cột} được điền theo từng học sinh
+LayoutOp = namedtuple("LayoutOp", ["kind", "text", "params"])
+
+_formatter = string.Formatter()
+# Độ rộng các đoạn chữ tĩnh, đo một lần mỗi tiến trình: (text, font, kiểu, cỡ chữ) -> độ rộng
+_static_widths = {}
+
+
+def font(style="", size=0):
+    """Đổi kiểu chữ; size=0 giữ cỡ chữ hiện tại (giống pdf.set_font)"""
+    return LayoutOp("font", None, (style, size))
+
+
+def color(r, g, b):
+    return LayoutOp("color", None, (r, g, b))
+
+
+def indent(w):
+    """Ô trống để thụt đầu dòng"""
+    return LayoutOp("indent", None, (w,))
+
+
+def space(h):
+    return LayoutOp("space", None, (h,))
+
+
+def page():
+    return LayoutOp("page", None, ())
+
+
+def image(path, x, y, w):
+    return LayoutOp("image", None, (path, x, y, w))
+
+
+def line(text, h=8, w=0, align="L", link=None):
+    """Một dòng (pdf.cell) rồi xuống dòng"""
+    return LayoutOp("line", text, (w, h, align, link))
+
+
+def title(text):
+    """Dòng tiêu đề căn giữa"""
+    return line(text, h=10, w=200, align="C")
+
+
+def inline(text, h=8, pad=2):
+    """Ô vừa khít nội dung, không xuống dòng (vd. trước một link trên cùng dòng)"""
+    return LayoutOp("inline", text, (h, pad))
+
+
+def paragraph(text, h=8):
+    """Đoạn văn nhiều dòng (pdf.multi_cell) rồi xuống dòng"""
+    return LayoutOp("paragraph", text, (h,))
+
+
+def slot(name):
+    """Phần nội dung do hàm slots[name](pdf, values) vẽ (vd. danh sách nội dung cần cải thiện)"""
+    return LayoutOp("slot", name, ())
+
+
+def when(flag, then, otherwise=()):
+    """Vẽ then nếu values[flag] đúng, ngược lại vẽ otherwise"""
+    return LayoutOp("when", flag, (tuple(then), tuple(otherwise)))
+
+
+def _draw_line(pdf, text, w, h, align, link):
+    pdf.cell(w, h, text, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align, link=link)
+
+
+def _draw_paragraph(pdf, text, h):
+    pdf.multi_cell(0, h, text, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+
+def _static_width(pdf, text):
+    key = (text, pdf.font_family, pdf.font_style, pdf.font_size_pt)
+    width = _static_widths.get(key)
+    if width is None:
+        width = _static_widths[key] = pdf.get_string_width(text)
+    return width
+
+
+def _draw_inline(pdf, text, h, pad, width=None):
+    if width is None:
+        width = pdf.get_string_width(text)
+    pdf.cell(width + pad, h, text)
+
+
+def _compile_text(text):
+    """Chuỗi tĩnh nếu text không có trường {…}, ngược lại None (phải điền theo từng học sinh)"""
+    if all(field is None for _, field, _, _ in _formatter.parse(text)):
+        return text.format_map({})
+    return None
+
+
+class CompiledLayout:
+    """
+    Bố cục báo cáo đã biên dịch: chuỗi các bước vẽ. Chữ tĩnh (tiêu đề, đoạn văn cố định, lời kết)
+    được xử lý sẵn một lần; mỗi học sinh chỉ điền các trường {…} và các slot.
+    """
+
+    def __init__(self, ops, slots=None):
+        self.slots = slots or {}
+        self.static_steps = 0
+        self.dynamic_steps = 0
+        self.steps = self._compile(ops)
+
+    def _compile(self, ops):
+        steps = []
+        for op in ops:
+            if op.kind == "when":
+                then_steps, otherwise_steps = (self._compile(branch) for branch in op.params)
+                steps.append(self._when_step(op.text, then_steps, otherwise_steps))
+                continue
+            if op.kind == "slot":
+                if op.text not in self.slots:
+                    raise KeyError(f"Không có hàm vẽ cho slot '{op.text}'")
+                slot_fn = self.slots[op.text]
+                steps.append(lambda pdf, values, slot_fn=slot_fn: slot_fn(pdf, values))
+                self.dynamic_steps += 1
+                continue
+            if op.text is None:
+                steps.append(self._fixed_step(op))
+                self.static_steps += 1
+                continue
+
+            static_text = _compile_text(op.text)
+            if static_text is not None:
+                steps.append(self._static_text_step(op, static_text))
+                self.static_steps += 1
+            else:
+                steps.append(self._dynamic_text_step(op, op.text))
+                self.dynamic_steps += 1
+        return tuple(steps)
+
+    @staticmethod
+    def _when_step(flag, then_steps, otherwise_steps):
+        def step(pdf, values):
+            for branch_step in (then_steps if values[flag] else otherwise_steps):
+                branch_step(pdf, values)
+        return step
+
+    @staticmethod
+    def _fixed_step(op):
+        if op.kind == "font":
+            style, size = op.params
+            return lambda pdf, values: pdf.set_font(FONT_FAMILY, style=style, size=size)
+        if op.kind == "color":
+            return lambda pdf, values: pdf.set_text_color(*op.params)
+        if op.kind == "indent":
+            return lambda pdf, values: pdf.cell(op.params[0])
+        if op.kind == "space":
+            return lambda pdf, values: pdf.ln(op.params[0])
+        if op.kind == "page":
+            return lambda pdf, values: pdf.add_page()
+        if op.kind == "image":
+            path, x, y, w = op.params
+            return lambda pdf, values: cached_image(pdf, path, x=x, y=y, w=w)
+        raise ValueError(f"Thao tác bố cục không hợp lệ: {op.kind}")
+
+    @staticmethod
+    def _static_text_step(op, text):
+        if op.kind == "line":
+            return lambda pdf, values: _draw_line(pdf, text, *op.params)
+        if op.kind == "paragraph":
+            return lambda pdf, values: _draw_paragraph(pdf, text, *op.params)
+        if op.kind == "inline":
+            return lambda pdf, values: _draw_inline(pdf, text, *op.params, width=_static_width(pdf, text))
+        raise ValueError(f"Thao tác bố cục không hợp lệ: {op.kind}")
+
+    @staticmethod
+    def _dynamic_text_step(op, template):
+        if op.kind == "line":
+            return lambda pdf, values: _draw_line(pdf, template.format_map(values), *op.params)
+        if op.kind == "paragraph":
+            return lambda pdf, values: _draw_paragraph(pdf, template.format_map(values), *op.params)
+        if op.kind == "inline":
+            return lambda pdf, values: _draw_inline(pdf, template.format_map(values), *op.params)
+        raise ValueError(f"Thao tác bố cục không hợp lệ: {op.kind}")
+
+    def render(self, pdf, values):
+        """Vẽ bố cục vào pdf với các giá trị của một học sinh"""
+        for step in self.steps:
+            step(pdf, values)
+
+    def render_to_file(self, row, fields, pdf_path, creation_date=None):
+        """
+        Tạo PDF một trang mới từ bố cục và ghi ra pdf_path
+
+        Args:
+            row (Series): Dòng kết quả của học sinh
+            fields (dict): Các giá trị tính thêm (phần trăm, nhận xét đã làm gọn, cờ cho when(...)),
+                được ưu tiên hơn cột cùng tên trong row
+            pdf_path (str): Đường dẫn file PDF
+            creation_date (datetime, optional): Ngày tạo ghi vào PDF
+        """
+        pdf = FPDF()
+        if creation_date is not None:
+            pdf.set_creation_date(creation_date)
+        pdf.add_page()
+        add_dejavu_fonts(pdf, FONT_DIR, family=FONT_FAMILY)
+
+        values = ChainMap(fields, {"row": row}, row)
+        self.render(pdf, values)
+        pdf.output(pdf_path)
+
+
+def compile_layout(ops, slots=None):
+    """Biên dịch định nghĩa báo cáo (danh sách thao tác) thành CompiledLayout"""
+    return CompiledLayout(ops, slots)
+
+
+def check_and_add_page(pdf, lines_count, line_height=8, margin_bottom=15):
+    """Kiểm tra nếu không đủ chỗ cho n dòng nữa thì thêm trang"""
+    needed_space = lines_count * line_height
+    if pdf.get_y() + needed_space + margin_bottom > pdf.h:
+        pdf.add_page()
+
+
+def draw_subject_tree(pdf, groups):
+    """Vẽ cây Môn → Chủ đề → bài (các SubjectGroup của improvement_parser, đã theo thứ tự in)"""
+    for group in groups:
+        pdf.set_font(FONT_FAMILY, style="I")
+        pdf.cell(0, 8, f"- {group.subject}", ln=True)
+        pdf.set_font(FONT_FAMILY, size=11)
+        for topic, lessons in group.topics:
+            check_and_add_page(pdf, lines_count=1 + len(lessons))
+
+            pdf.cell(8)
+            pdf.cell(0, 8, f"• {topic}:", ln=True)
+            for lesson in lessons:
+                pdf.cell(16)
+                pdf.cell(0, 8, f"◦ {lesson}", ln=True)
@@ -0,0 +1,106 @@
+import os
+import time
+import sqlite3
+import hashlib
+from logger_config import logger
+from utils.helpers import prompt_template_version
+
+# Cache phản hồi Gemini theo prompt, dùng chung cho mọi tiến trình
+RESPONSE_CACHE_FILE = "data/cache/gemini_responses.sqlite3"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 30 * 24 * 3600))  # 30 ngày
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 50000))
+
+
+def response_key(model_name, prompt):
+    """Khóa cache: hash của (model, phiên bản template prompt, prompt đã render)"""
+    raw = "\x1f".join([model_name, prompt_template_version(), prompt])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache SQLite cho phản hồi Gemini, khóa theo nội dung prompt. Mỗi tiến trình mở kết nối riêng
+    tới cùng một file (WAL), nên các worker dùng chung cache. Entry hết hạn theo TTL,
+    số entry được giới hạn (xóa entry ít dùng gần đây nhất).
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = None
+        self.conn_pid = None
+        self.puts = 0
+
+    def _connect(self):
+        # Kết nối SQLite không dùng chung được giữa các tiến trình
+        if self.conn is None or self.conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30)
+            self.conn_pid = os.getpid()
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+            self.conn.commit()
+        return self.conn
+
+    def get(self, model_name, prompt):
+        """Lấy phản hồi đã cache (None nếu chưa có hoặc đã hết hạn)"""
+        key = response_key(model_name, prompt)
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            response, created_at = row
+            if now - created_at > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                return None
+
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return response
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Lỗi đọc cache phản hồi: {e}")
+            return None
+
+    def put(self, model_name, prompt, response):
+        """Lưu phản hồi vào cache"""
+        key = response_key(model_name, prompt)
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            conn.commit()
+
+            self.puts += 1
+            if self.puts % 100 == 1:
+                self._evict(now)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Lỗi ghi cache phản hồi: {e}")
+
+    def _evict(self, now):
+        """Xóa entry hết hạn và entry ít dùng nhất khi vượt quá giới hạn"""
+        conn = self._connect()
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        conn.commit()
+
+
+# Global response cache
+response_cache = ResponseCache()
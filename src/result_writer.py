@@ -0,0 +1,126 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from logger_config import logger
+
+SIDE_OUTPUT_FORMATS = ("csv", "parquet")
+# Side output mặc định: file của từng sheet là bản ghi duy nhất nằm trên đĩa ngay khi sheet xong
+# (output.xlsx chỉ được lưu lúc đóng writer). Đặt RESULT_SIDE_FORMATS="" để tắt, "csv,parquet" để ghi cả hai
+DEFAULT_SIDE_FORMATS = tuple(fmt.strip() for fmt in os.getenv("RESULT_SIDE_FORMATS", "csv").split(",") if fmt.strip())
+
+# Định dạng header giống pandas.DataFrame.to_excel
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="top")
+
+
+def _excel_value(value):
+    """Chuyển giá trị pandas/numpy sang kiểu openpyxl ghi được (NaN -> ô trống)"""
+    if value is None:
+        return None
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (str, int, float, bool, datetime.date, datetime.datetime, datetime.time)):
+        return value
+    return str(value)
+
+
+class StreamingResultWriter:
+    """
+    Ghi kết quả ra output.xlsx theo từng sheet ngay khi sheet hoàn thành (workbook write-only,
+    bộ nhớ không phụ thuộc số sheet). Định dạng xlsx không ghi dở được: file chỉ có trên đĩa sau close(),
+    nên mỗi sheet còn được ghi ngay ra file CSV/Parquet riêng (mặc định CSV, xem DEFAULT_SIDE_FORMATS);
+    nếu tiến trình bị dừng giữa chừng, các sheet đã xong vẫn còn ở side_output_dir.
+    """
+
+    def __init__(self, output_file, side_output_dir=None, side_formats=DEFAULT_SIDE_FORMATS):
+        self.output_file = output_file
+        self.side_output_dir = side_output_dir
+        self.side_formats = []
+        self.sheet_rows = {}
+        self.workbook = Workbook(write_only=True)
+
+        for fmt in side_formats:
+            if fmt not in SIDE_OUTPUT_FORMATS:
+                raise ValueError(f"Định dạng side output không hỗ trợ: {fmt}")
+            if fmt == "parquet":
+                try:
+                    import pyarrow  # noqa: F401
+                except ImportError:
+                    logger.warning("⚠️ Chưa cài pyarrow, bỏ qua side output Parquet")
+                    continue
+            self.side_formats.append(fmt)
+
+        if self.side_formats and self.side_output_dir:
+            os.makedirs(self.side_output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Vẫn lưu các sheet đã xong nếu quá trình xử lý bị lỗi giữa chừng
+        self.close()
+        return False
+
+    def write_sheet(self, sheet_name, df):
+        """Ghi một sheet vào workbook và side output (nếu có)"""
+        worksheet = self.workbook.create_sheet(title=sheet_name)
+
+        header = []
+        for column in df.columns:
+            cell = WriteOnlyCell(worksheet, value=_excel_value(column))
+            cell.font = HEADER_FONT
+            cell.border = HEADER_BORDER
+            cell.alignment = HEADER_ALIGNMENT
+            header.append(cell)
+        worksheet.append(header)
+
+        for row in df.itertuples(index=False, name=None):
+            worksheet.append([_excel_value(value) for value in row])
+
+        self.sheet_rows[sheet_name] = len(df)
+        self._write_side_outputs(sheet_name, df)
+        logger.info(f"💾 Đã ghi sheet {sheet_name} ({len(df)} dòng)")
+
+    def _write_side_outputs(self, sheet_name, df):
+        if not self.side_formats or not self.side_output_dir:
+            return
+
+        base_path = os.path.join(self.side_output_dir, sheet_name)
+        for fmt in self.side_formats:
+            # Ghi ra file tạm rồi đổi tên: bị dừng giữa chừng thì không để lại file ghi dở
+            path = f"{base_path}.{fmt}"
+            tmp_path = f"{path}.tmp"
+            if fmt == "csv":
+                df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+            elif fmt == "parquet":
+                # Cột object có thể lẫn số và chữ, ghi dưới dạng chuỗi (giữ ô trống)
+                object_columns = {column: "string" for column in df.columns if df[column].dtype == object}
+                df.astype(object_columns).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    def close(self):
+        """Lưu workbook (chỉ lưu một lần)"""
+        if self.workbook is None:
+            return
+
+        if self.sheet_rows:
+            os.makedirs(os.path.dirname(self.output_file) or ".", exist_ok=True)
+            tmp_file = f"{self.output_file}.tmp"
+            self.workbook.save(tmp_file)
+            os.replace(tmp_file, self.output_file)
+            logger.info(f"Kết quả đã lưu vào {self.output_file}")
+        else:
+            logger.warning("⚠️ Không có sheet nào để lưu")
+
+        self.workbook = None
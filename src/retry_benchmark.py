@@ -0,0 +1,102 @@
+"""
+Đo backoff theo retry hint so với sleep cố định trên server Gemini giả lập trả lỗi 429 theo quota.
+
+Server giả lập chạy trong tiến trình, quota Service Account là --rpm request trong --quota-window giây.
+Các delay (base 1s, tối đa 60s, sleep cố định 15s như trước đây) được co lại theo tỉ lệ quota-window / 60
+để một lần đo chỉ mất vài giây:
+    python src/retry_benchmark.py --tasks 30 --workers 4 --rpm 10 --quota-window 2
+
+In ra mỗi chiến lược: thời gian tổng, số request, số lỗi 429 (lượt thử bị lãng phí), số nhận xét dự phòng.
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fake_gemini_server import create_server
+from retry_policy import RetryPolicy
+
+# Sleep cố định khi bị rate limit trước khi có retry policy (giây, với cửa sổ quota 60s)
+FIXED_RATE_LIMIT_SLEEP = 15.0
+
+
+class FixedDelayPolicy(RetryPolicy):
+    """Sleep cố định, bỏ qua retry hint (cách xử lý rate limit trước đây)"""
+
+    def next_delay(self, previous_delay, retry_hint=None):
+        return self.base_delay
+
+
+def make_tasks(prefix, count):
+    return [
+        (f"{prefix} {i}", "6A1", 50 + i, 10, 5, 5, 20, "50%", "40%", 50, 40, "Môn Toán - Chủ đề T1: Bài 1")
+        for i in range(count)
+    ]
+
+
+def run_strategy(name, policy, url, tasks, workers):
+    """Chạy toàn bộ task với một retry policy, trả về thống kê của lần chạy"""
+    import service_account_processor
+    import rate_limiter
+    from urllib.request import urlopen, Request
+
+    urlopen(Request(f"{url}/reset", method="POST")).read()
+    service_account_processor.retry_policy = policy
+    # Bucket mới, đủ lớn để chỉ quota của server quyết định tốc độ
+    rate_limiter._rate_limiter = rate_limiter.TokenBucket(requests_per_minute=10 ** 6)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(service_account_processor.generate_feedback_service_account, tasks))
+    elapsed = time.time() - started
+
+    stats = json.loads(urlopen(f"{url}/stats").read())
+    return {
+        "strategy": name,
+        "seconds": round(elapsed, 2),
+        "requests": stats["requests"],
+        "rate_limited": stats["status_counts"].get("429", 0),
+        "fallbacks": sum(1 for _, _, is_fallback in results if is_fallback),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="So sánh backoff theo retry hint với sleep cố định khi bị 429")
+    parser.add_argument("--tasks", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=10, help="Quota request của Service Account trong mỗi cửa sổ")
+    parser.add_argument("--quota-window", type=float, default=2.0)
+    parser.add_argument("--latency", default="fixed:0.01")
+    args = parser.parse_args()
+
+    server = create_server(port=0, latency=args.latency, service_account_rpm=args.rpm,
+                           quota_window=args.quota_window, seed=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    # Cấu hình phải có trước khi import các module đọc biến môi trường lúc import
+    os.environ["GEMINI_API_ENDPOINT"] = url
+    from response_cache import response_cache
+
+    scale = args.quota_window / 60
+    strategies = [
+        ("retry_hint", RetryPolicy(base_delay=scale, max_delay=60 * scale)),
+        ("fixed_sleep", FixedDelayPolicy(base_delay=FIXED_RATE_LIMIT_SLEEP * scale)),
+    ]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        response_cache.path = os.path.join(cache_dir, "response_cache.sqlite3")
+        try:
+            # Tên học sinh khác nhau giữa các lần chạy để không dùng lại phản hồi đã cache
+            results = [run_strategy(name, policy, url, make_tasks(name, args.tasks), args.workers)
+                       for name, policy in strategies]
+        finally:
+            server.shutdown()
+
+    print(json.dumps(results, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
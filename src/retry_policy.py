@@ -0,0 +1,142 @@
+import re
+import random
+from collections import namedtuple
+
+# Thông tin lỗi đã phân tích từ exception của Gemini
+ErrorInfo = namedtuple("ErrorInfo", ["status_code", "retry_delay", "quota_metric", "quota_id", "reason", "is_rate_limit", "is_invalid_key"])
+
+RETRY_DELAY_PATTERNS = [
+    re.compile(r"Please retry in (\d+(?:\.\d+)?)s"),               # "Please retry in X.Xs"
+    re.compile(r"retry_delay\s*{\s*seconds:\s*(\d+)"),              # "retry_delay { seconds: X }"
+    re.compile(r"\"retryDelay\"\s*:\s*\"(\d+(?:\.\d+)?)s\""),        # JSON: "retryDelay": "Xs"
+]
+DURATION_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)s\s*$")
+
+
+def parse_retry_delay(text):
+    """Trích xuất retry delay (giây) từ message lỗi bằng regex (None nếu không có)"""
+    for pattern in RETRY_DELAY_PATTERNS:
+        match = pattern.search(str(text))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def _detail_type(detail):
+    if isinstance(detail, dict):
+        return detail.get("@type", "").rsplit(".", 1)[-1]
+    return type(detail).__name__
+
+
+def _duration_seconds(value):
+    """Duration protobuf (seconds + nanos) hoặc chuỗi JSON "12.5s" -> số giây"""
+    if isinstance(value, str):
+        match = DURATION_PATTERN.match(value)
+        return float(match.group(1)) if match else None
+    if value is None:
+        return None
+    return getattr(value, "seconds", 0) + getattr(value, "nanos", 0) / 1e9
+
+
+def _field(obj, snake_name, camel_name):
+    if isinstance(obj, dict):
+        return obj.get(camel_name, obj.get(snake_name))
+    return getattr(obj, snake_name, None)
+
+
+def classify_error(error):
+    """
+    Phân tích exception của Gemini: status code, RetryInfo, QuotaFailure, ErrorInfo
+    (google.api_core.exceptions.GoogleAPICallError, qua REST hoặc gRPC). Nếu không có
+    metadata có cấu trúc thì dùng regex trên message.
+    """
+    message = str(error)
+    message_lower = message.lower()
+
+    status_code = getattr(error, "code", None)
+    if not isinstance(status_code, int):
+        status_code = None
+
+    retry_delay = None
+    quota_metric = None
+    quota_id = None
+    reason = getattr(error, "reason", None)
+
+    try:
+        details = list(getattr(error, "details", None) or [])
+    except Exception:
+        details = []
+
+    for detail in details:
+        detail_type = _detail_type(detail)
+        if detail_type == "RetryInfo":
+            retry_delay = _duration_seconds(_field(detail, "retry_delay", "retryDelay"))
+        elif detail_type == "QuotaFailure":
+            violations = _field(detail, "violations", "violations") or []
+            if len(violations) > 0:
+                quota_metric = _field(violations[0], "quota_metric", "quotaMetric") or _field(violations[0], "subject", "subject")
+                quota_id = _field(violations[0], "quota_id", "quotaId")
+        elif detail_type == "ErrorInfo" and not reason:
+            reason = _field(detail, "reason", "reason")
+
+    if retry_delay is None:
+        retry_delay = parse_retry_delay(message)
+
+    if status_code is not None:
+        is_rate_limit = status_code == 429 or reason in ("RATE_LIMIT_EXCEEDED", "RESOURCE_EXHAUSTED") or quota_metric is not None
+    else:
+        # Exception không có status code: đoán theo message như trước đây
+        is_rate_limit = "quota" in message_lower or "rate" in message_lower or "429" in message
+
+    is_invalid_key = reason in ("API_KEY_INVALID", "API_KEY_EXPIRED") or (
+        status_code in (None, 400) and "400" in message and "api key" in message_lower
+        and ("expired" in message_lower or "invalid" in message_lower)
+    )
+
+    return ErrorInfo(status_code, retry_delay, quota_metric, quota_id, reason, is_rate_limit, is_invalid_key)
+
+
+class RetryPolicy:
+    """
+    Backoff cho request Gemini: decorrelated jitter (delay = random(base, delay trước × 3), tối đa max_delay).
+    Khi server trả về retry hint thì không thử lại sớm hơn hint và chỉ cộng thêm một phần jitter nhỏ,
+    để các tiến trình không cùng thử lại một lúc.
+    """
+
+    def __init__(self, base_delay=1.0, max_delay=60.0, hint_jitter=0.2, rng=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hint_jitter = hint_jitter
+        self.rng = rng or random.Random()
+
+    def next_delay(self, previous_delay, retry_hint=None):
+        """
+        Tính delay cho lần thử tiếp theo
+
+        Args:
+            previous_delay (float): Delay của lần thử trước (0 nếu là lần đầu)
+            retry_hint (float, optional): Retry delay do server trả về
+        """
+        upper = max(self.base_delay, previous_delay * 3)
+        delay = min(self.max_delay, self.rng.uniform(self.base_delay, upper))
+
+        if retry_hint is not None:
+            # Không sớm hơn hint, không muộn hơn hint + jitter
+            delay = retry_hint + min(delay, retry_hint * self.hint_jitter + self.base_delay)
+
+        return delay
+
+    def describe(self, info, delay):
+        """Mô tả ngắn gọn lỗi + delay cho log"""
+        parts = [f"status={info.status_code}"] if info.status_code else []
+        if info.quota_metric:
+            parts.append(f"quota={info.quota_metric}")
+        if info.retry_delay is not None:
+            parts.append(f"hint={info.retry_delay:.1f}s")
+        parts.append(f"đợi {delay:.1f}s")
+        return ", ".join(parts)
+
+
+# Global retry policy
+retry_policy = RetryPolicy()
+
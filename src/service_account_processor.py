@@ -1,20 +1,37 @@
 import os
+import re
 import time
 import pandas as pd
-import google.generativeai as genai
 from dotenv import load_dotenv
 from logger_config import logger
-from utils.helpers import load_prompt
+from utils.helpers import build_feedback_prompt, GEMINI_MODEL, GEMINI_API_ENDPOINT
+from feedback_journal import feedback_journal
+from response_cache import response_cache
+from rate_limiter import get_rate_limiter, init_worker_rate_limiter
+from gemini_client import get_model
+from retry_policy import classify_error, retry_policy
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing as mp
-from datetime import datetime, timedelta
-import threading
 from collections import defaultdict
 import json
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
 
 load_dotenv()
 
+# Gộp học sinh có cùng dữ liệu kết quả (khác tên) vào một request, tên được thay vào sau
+FEEDBACK_DEDUPE = os.getenv("FEEDBACK_DEDUPE", "0") == "1"
+NAME_PLACEHOLDER = "[TÊN_THÍ_SINH]"
+# Thêm vào prompt của nhóm để Gemini giữ nguyên tên giữ chỗ
+PLACEHOLDER_INSTRUCTION = (
+    f"\n\nLưu ý: {NAME_PLACEHOLDER} là tên giữ chỗ, không phải tên thật. Mỗi khi gọi tên học sinh, hãy viết nguyên văn "
+    f"{NAME_PLACEHOLDER} (giữ cả dấu ngoặc vuông), không dịch, không sửa và không thay bằng tên hay đại từ khác."
+)
+# Số lần gửi lại khi nhận xét của nhóm không giữ đúng tên giữ chỗ, sau đó tạo riêng cho từng học sinh
+PLACEHOLDER_RETRIES = int(os.getenv("FEEDBACK_PLACEHOLDER_RETRIES", 2))
+# Tên giữ chỗ bị Gemini sửa dở (mất ngoặc, đổi dạng) hoặc token trong ngoặc vuông còn sót
+LEFTOVER_TOKEN_PATTERN = re.compile(r"\[[^\]]*\]|T[ÊE]N[_ ]TH[ÍI][_ ]SINH", re.IGNORECASE)
+
 class ServiceAccountProcessor:
     """
     Processor chỉ sử dụng Service Account, không dùng API keys
@@ -22,8 +39,10 @@ class ServiceAccountProcessor:
     
     def __init__(self):
         self.service_account_creds = self._create_service_account()
-        self.request_count = []
-        self.lock = threading.Lock()
+        if self.service_account_creds is None and GEMINI_API_ENDPOINT:
+            # Chạy với server giả lập: không cần Service Account thật
+            logger.info(f"🧪 Dùng Service Account ẩn danh với endpoint {GEMINI_API_ENDPOINT}")
+            self.service_account_creds = AnonymousCredentials()
         
     def _create_service_account(self):
         """Tạo Service Account credentials từ env vars"""
@@ -93,34 +112,15 @@ class ServiceAccountProcessor:
             logger.error(f"❌ Lỗi tạo Service Account: {e}")
             return None
     
-    def can_make_request(self):
-        """Kiểm tra có thể gửi request không (60 req/min limit)"""
-        with self.lock:
-            current_time = datetime.now()
-            one_minute_ago = current_time - timedelta(minutes=1)
-            
-            # Cleanup old requests
-            self.request_count = [req_time for req_time in self.request_count if req_time > one_minute_ago]
-            
-            return len(self.request_count) < 60
-    
-    def record_request(self):
-        """Ghi nhận một request"""
-        with self.lock:
-            self.request_count.append(datetime.now())
+    def wait_for_request_slot(self):
+        """Chờ đến lượt gửi request theo token bucket dùng chung giữa các tiến trình"""
+        return get_rate_limiter().wait()
     
     def get_stats(self):
         """Lấy thống kê"""
-        with self.lock:
-            current_time = datetime.now()
-            one_minute_ago = current_time - timedelta(minutes=1)
-            recent_requests = [req_time for req_time in self.request_count if req_time > one_minute_ago]
-            
-            return {
-                'recent_requests': len(recent_requests),
-                'remaining_quota': 60 - len(recent_requests),
-                'service_account_available': self.service_account_creds is not None
-            }
+        stats = get_rate_limiter().get_stats()
+        stats['service_account_available'] = self.service_account_creds is not None
+        return stats
 
 # Global service account processor
 sa_processor = ServiceAccountProcessor()
@@ -128,6 +128,10 @@ sa_processor = ServiceAccountProcessor()
 def generate_feedback_service_account(args):
     """
     Tạo feedback chỉ bằng Service Account
+
+    Returns:
+        tuple: (student_name, nhận xét, True nếu là nhận xét dự phòng). Với request của nhóm (tên là
+            NAME_PLACEHOLDER), nhận xét là None nếu Gemini không giữ đúng tên giữ chỗ: cần tạo riêng từng học sinh
     """
     (student_name, class_name, point, correct, wrong, skip, total_questions, correct_basic, correct_advanced,
      percent_basic, percent_advanced, improvement_content) = args
@@ -136,123 +140,98 @@ def generate_feedback_service_account(args):
     if pd.isna(student_name) or not student_name or str(student_name).strip() == "" or str(student_name).lower() == 'nan':
         logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Tên học sinh không hợp lệ: {student_name}, bỏ qua...")
         fallback = f"Học sinh đạt {point} điểm trong bài kiểm tra. Cần tiếp tục cố gắng để đạt kết quả tốt hơn."
-        return (str(student_name), fallback)
+        return (str(student_name), fallback, True)
     
+    # Prompt giống nhau thì dùng lại phản hồi đã có, không tốn quota
+    grouped = student_name == NAME_PLACEHOLDER
+    prompt = build_feedback_prompt(args)
+    if grouped:
+        prompt += PLACEHOLDER_INSTRUCTION
+    cached_comment = response_cache.get(GEMINI_MODEL, prompt)
+    if cached_comment is not None and grouped and not is_valid_group_comment(cached_comment):
+        logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Nhận xét nhóm đã cache không giữ đúng tên giữ chỗ, tạo lại")
+        cached_comment = None
+    if cached_comment is not None:
+        logger.info(f"⚡ [Tiến trình {os.getpid()}] Dùng nhận xét đã cache cho {student_name}")
+        return (student_name, cached_comment, False)
+
     logger.info(f"[Tiến trình {os.getpid()}] Bắt đầu xử lý {student_name} với Service Account...")
     
     max_attempts = 30
+    backoff_delay = 0.0
+    invalid_replies = 0
     
     for attempt in range(max_attempts):
-        # Kiểm tra rate limit
-        if not sa_processor.can_make_request():
-            logger.warning(f"⏳ [Tiến trình {os.getpid()}] Service Account rate limit, đợi 10s...")
-            time.sleep(10)
-            continue
-        
         try:
-            # Tạo lại Service Account credentials trong child process
-            project_id = os.getenv('PROJECT_ID')
-            private_key = os.getenv('PRIVATE_KEY')
-            client_email = os.getenv('CLIENT_EMAIL')
-            
-            if not all([project_id, private_key, client_email]):
+            # Credentials được tạo một lần khi tiến trình import module (sa_processor),
+            # model Gemini được cache theo tiến trình
+            if sa_processor.service_account_creds is None:
                 logger.error(f"❌ [Tiến trình {os.getpid()}] Thiếu thông tin Service Account")
                 break
-                
-            service_account_info = {
-                "type": os.getenv('TYPE', 'service_account'),
-                "project_id": project_id,
-                "private_key_id": os.getenv('PRIVATE_KEY_ID'),
-                "private_key": private_key.replace('\\n', '\n'),
-                "client_email": client_email,
-                "client_id": os.getenv('CLIENT_ID', ''),
-                "auth_uri": os.getenv('AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
-                "token_uri": os.getenv('TOKEN_URI', 'https://oauth2.googleapis.com/token'),
-                "auth_provider_x509_cert_url": os.getenv('AUTH_PROVIDER_X509_CERT_URL'),
-                "client_x509_cert_url": os.getenv('CLIENT_X509_CERT_URL'),
-                "universe_domain": os.getenv('UNIVERSE_DOMAIN', 'googleapis.com')
-            }
-            
-            credentials = service_account.Credentials.from_service_account_info(
-                service_account_info,
-                scopes=[
-                    'https://www.googleapis.com/auth/cloud-platform',
-                    'https://www.googleapis.com/auth/generative-language'
-                ]
-            )
-            
-            # Configure genai với Service Account
-            genai.configure(credentials=credentials)
-            model = genai.GenerativeModel('gemini-2.0-flash')
-
-            # Tạo prompt
-            prompt = load_prompt(
-                student_name=student_name,
-                point=f"{point}/135",
-                correct=correct,
-                wrong=wrong,
-                skip=skip,
-                total_questions=total_questions,
-                correct_basic=correct_basic,
-                percent_basic=percent_basic,
-                correct_advanced=correct_advanced,
-                percent_advanced=percent_advanced,
-                improvement_content=improvement_content,
-            )
-
-            # Gửi request
-            sa_processor.record_request()
+
+            model = get_model("service_account", sa_processor.service_account_creds)
+
+            # Chờ đến lượt theo token bucket dùng chung rồi gửi request
+            waited = sa_processor.wait_for_request_slot()
+            if waited > 1:
+                logger.info(f"⏳ [Tiến trình {os.getpid()}] Đã chờ {waited:.1f}s theo rate limit")
             response = model.generate_content(prompt)
             response.resolve()
             gemini_comment = response.text
 
+            # Nhận xét nhóm sai tên giữ chỗ thì không được cache, không được gán cho học sinh
+            if grouped and not is_valid_group_comment(gemini_comment):
+                invalid_replies += 1
+                if invalid_replies > PLACEHOLDER_RETRIES:
+                    logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Nhận xét nhóm không giữ đúng {NAME_PLACEHOLDER} "
+                                   f"sau {invalid_replies} lần, chuyển sang tạo riêng từng học sinh")
+                    return (student_name, None, True)
+                logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Nhận xét nhóm không giữ đúng {NAME_PLACEHOLDER}, "
+                               f"gửi lại ({invalid_replies}/{PLACEHOLDER_RETRIES})")
+                continue
+
+            response_cache.put(GEMINI_MODEL, prompt, gemini_comment)
+
             logger.info(f"✅ [Tiến trình {os.getpid()}] Thành công cho {student_name} với Service Account")
-            return (student_name, gemini_comment)
+            return (student_name, gemini_comment, False)
 
         except Exception as e:
-            error_msg = str(e)
-            error_lower = error_msg.lower()
+            info = classify_error(e)
+            backoff_delay = retry_policy.next_delay(backoff_delay, info.retry_delay)
             
-            # Xử lý rate limit
-            if "quota" in error_lower or "rate" in error_lower or "429" in error_msg:
-                logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Service Account rate limit cho {student_name}")
-                time.sleep(15)  # Đợi lâu hơn cho Service Account
+            # Xử lý rate limit: tạm dừng mọi tiến trình qua token bucket dùng chung
+            if info.is_rate_limit:
+                logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Service Account rate limit cho {student_name} ({retry_policy.describe(info, backoff_delay)})")
+                get_rate_limiter().penalize(backoff_delay)
                 continue
                 
             # Xử lý lỗi khác
             else:
-                logger.error(f"❌ [Tiến trình {os.getpid()}] Lỗi Service Account cho {student_name}: {str(e)[:100]}...")
-                time.sleep(5)
+                logger.error(f"❌ [Tiến trình {os.getpid()}] Lỗi Service Account cho {student_name}: {str(e)[:100]}... ({retry_policy.describe(info, backoff_delay)})")
+                time.sleep(backoff_delay)
                 continue
 
-    # Fallback comment
-    fallback_comment = (
+    logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Dùng nhận xét dự phòng cho {student_name} sau {max_attempts} lần thử.")
+    return (student_name, fallback_comment(args), True)
+
+def fallback_comment(task_args):
+    """Nhận xét dự phòng khi không tạo được nhận xét bằng Gemini"""
+    (student_name, class_name, point, correct, wrong, skip, total_questions, correct_basic, correct_advanced,
+     percent_basic, percent_advanced, improvement_content) = task_args
+
+    return (
         f"{student_name} đã đạt {point} điểm trong bài kiểm tra. "
         f"Ở phần kiến thức cơ bản, thí sinh làm đúng {correct_basic} câu ({percent_basic}%), "
         f"còn ở phần nâng cao thí sinh đạt {correct_advanced} câu ({percent_advanced}%). "
         f"Chúng tôi khích lệ thí sinh tiếp tục giữ vững tinh thần học tập và cố gắng tiến bộ hơn trong thời gian tới."
     )
 
-    logger.warning(f"⚠️ [Tiến trình {os.getpid()}] Dùng nhận xét dự phòng cho {student_name} sau {max_attempts} lần thử.")
-    return (student_name, fallback_comment)
-
-def process_feedbacks_service_account(new_df):
+def collect_feedback_tasks(new_df):
     """
-    Xử lý tạo nhận xét chỉ bằng Service Account
+    Tạo danh sách task (index, task_args) cho các học sinh hợp lệ trong sheet
     """
-    logger.info("🏢 Bắt đầu tạo nhận xét cho học sinh chỉ bằng Service Account...")
-    
-    if not sa_processor.service_account_creds:
-        logger.error("❌ Không có Service Account credentials!")
-        return new_df
-    
-    if "Nhận xét" not in new_df.columns:
-        new_df["Nhận xét"] = ""
-
-    # Filter ra các dòng không hợp lệ
-    valid_rows = []
     tasks = []
-    
+
     for index, row in new_df.iterrows():
         student_name = row["Họ và tên"] if "Họ và tên" in row else row.get("Tên hiển thị", "")
         
@@ -260,8 +239,6 @@ def process_feedbacks_service_account(new_df):
         if pd.isna(student_name) or not student_name or str(student_name).strip() == "" or str(student_name).lower() == 'nan':
             logger.warning(f"⚠️ Bỏ qua học sinh có tên không hợp lệ: {student_name}")
             continue
-            
-        valid_rows.append(index)
         
         class_name = row["Lớp"]
         point = row["Điểm"]
@@ -286,49 +263,136 @@ def process_feedbacks_service_account(new_df):
         )
         tasks.append((index, task_args))
 
+    return tasks
+
+def score_profile(task_args):
+    """Dữ liệu kết quả dùng trong prompt, trừ họ tên và lớp (học sinh cùng profile thì cùng prompt ngoài tên)"""
+    return tuple(task_args[2:])
+
+def group_tasks_by_profile(tasks):
+    """
+    Gộp các học sinh có cùng score profile
+
+    Returns:
+        list: [(task_args với tên là NAME_PLACEHOLDER, [(index, task_args), ...])]
+    """
+    groups = {}
+    for index, task_args in tasks:
+        groups.setdefault(score_profile(task_args), []).append((index, task_args))
+    return [((NAME_PLACEHOLDER,) + tuple(members[0][1][1:]), members) for members in groups.values()]
+
+def is_valid_group_comment(comment):
+    """Nhận xét chung của nhóm phải có tên giữ chỗ và không còn token trong ngoặc vuông nào khác"""
+    return NAME_PLACEHOLDER in comment and not LEFTOVER_TOKEN_PATTERN.search(comment.replace(NAME_PLACEHOLDER, ""))
+
+def personalize_comment(comment, student_name):
+    """Thay tên của học sinh vào nhận xét chung của nhóm"""
+    return comment.replace(NAME_PLACEHOLDER, str(student_name))
+
+def get_feedback_process_count(total_tasks=None):
+    """Số tiến trình dùng cho Service Account (tối đa 4 để tránh spam Service Account)"""
+    cpu_count = mp.cpu_count()
+    num_processes = min(4, cpu_count // 4)
+    if total_tasks is not None:
+        num_processes = min(num_processes, total_tasks)
+    return max(1, num_processes)  # Ít nhất 1 process
+
+def error_fallback_comment(student_name):
+    """Nhận xét dự phòng khi tiến trình tạo nhận xét bị lỗi"""
+    return f"{student_name} đạt điểm tốt trong bài kiểm tra. Tiếp tục cố gắng để đạt kết quả tốt hơn."
+
+def process_feedbacks_service_account(new_df, sheet_name="", resume=False, dedupe=FEEDBACK_DEDUPE):
+    """
+    Xử lý tạo nhận xét chỉ bằng Service Account.
+    Mỗi nhận xét được ghi vào nhật ký ngay khi nhận được (trừ nhận xét dự phòng)
+
+    Args:
+        new_df (DataFrame): Kết quả chấm điểm của sheet
+        sheet_name (str): Tên sheet (khóa trong nhật ký nhận xét)
+        resume (bool): Bỏ qua các học sinh đã có nhận xét trong nhật ký
+        dedupe (bool): Một request cho mỗi nhóm học sinh cùng kết quả (khác tên), tên được thay vào sau
+    """
+    logger.info("🏢 Bắt đầu tạo nhận xét cho học sinh chỉ bằng Service Account...")
+    
+    if not sa_processor.service_account_creds:
+        logger.error("❌ Không có Service Account credentials!")
+        return new_df
+    
+    if "Nhận xét" not in new_df.columns:
+        new_df["Nhận xét"] = ""
+
+    # Filter ra các dòng không hợp lệ
+    tasks = collect_feedback_tasks(new_df)
+
     logger.info(f"📊 Có {len(tasks)} học sinh hợp lệ để xử lý (bỏ qua {len(new_df) - len(tasks)} dòng không hợp lệ)")
     
     if not tasks:
         logger.error("❌ Không có học sinh hợp lệ nào để xử lý!")
         return new_df
+
+    if resume:
+        tasks, saved_comments = feedback_journal.split_completed(sheet_name, tasks)
+        for index, comment in saved_comments.items():
+            new_df.at[index, "Nhận xét"] = comment
+
+        if not tasks:
+            logger.info("✅ Tất cả học sinh đã có nhận xét trong nhật ký")
+            return new_df
     
+    if dedupe:
+        # Một request cho mỗi nhóm học sinh cùng kết quả, nhận xét dùng tên giữ chỗ
+        requests = group_tasks_by_profile(tasks)
+        logger.info(f"🧩 Gộp {len(tasks)} học sinh thành {len(requests)} nhóm cùng kết quả "
+                    f"(tỉ lệ {len(tasks) / len(requests):.2f} học sinh/request, giảm {1 - len(requests) / len(tasks):.0%} request)")
+    else:
+        requests = [(task_args, [(index, task_args)]) for index, task_args in tasks]
+
     # Sử dụng ít process hơn với Service Account (để tránh rate limit)
-    cpu_count = mp.cpu_count()
-    num_processes = min(4, cpu_count // 4, len(tasks))  # Tối đa 4 processes để tránh spam Service Account
-    num_processes = max(1, num_processes)  # Ít nhất 1 process
+    num_processes = get_feedback_process_count(len(requests))
     
-    logger.info(f"🔧 Sử dụng {num_processes} tiến trình để xử lý {len(tasks)} học sinh với Service Account...")
+    logger.info(f"🔧 Sử dụng {num_processes} tiến trình để xử lý {len(requests)} request cho {len(tasks)} học sinh với Service Account...")
     
     # Log thống kê ban đầu
     stats = sa_processor.get_stats()
     logger.info(f"📊 Service Account stats: {stats}")
     
-    with ProcessPoolExecutor(max_workers=num_processes) as executor:
-        future_to_data = {executor.submit(generate_feedback_service_account, task_args): (index, task_args) for index, task_args in tasks}
-        
+    with ProcessPoolExecutor(max_workers=num_processes, initializer=init_worker_rate_limiter,
+                             initargs=(get_rate_limiter(),)) as executor:
         completed = 0
         failed = 0
-        
-        for future in future_to_data:
-            try:
-                student_name, feedback = future.result(timeout=300)  # 5 phút timeout
-                index, _ = future_to_data[future]
-                new_df.at[index, "Nhận xét"] = feedback
-                completed += 1
+        pending_requests = requests
+
+        while pending_requests:
+            future_to_data = {executor.submit(generate_feedback_service_account, request_args): members
+                              for request_args, members in pending_requests}
+            pending_requests = []
+
+            for future in future_to_data:
+                members = future_to_data[future]
+                try:
+                    _, feedback, is_fallback = future.result(timeout=300)  # 5 phút timeout
+                    if feedback is None:
+                        # Nhận xét chung không dùng được cho nhóm: gửi lại riêng từng học sinh
+                        pending_requests += [(task_args, [(index, task_args)]) for index, task_args in members]
+                        continue
+                    for index, task_args in members:
+                        student_feedback = personalize_comment(feedback, task_args[0])
+                        new_df.at[index, "Nhận xét"] = student_feedback
+                        if not is_fallback:
+                            feedback_journal.record(sheet_name, index, task_args, student_feedback)
+                    completed += len(members)
                 
-                if completed % 5 == 0:  # Log ít hơn để giảm spam
-                    stats = sa_processor.get_stats()
-                    logger.info(f"📈 Đã hoàn thành {completed}/{len(tasks)} nhận xét... Service Account: {stats}")
+                    if completed % 5 == 0:  # Log ít hơn để giảm spam
+                        stats = sa_processor.get_stats()
+                        logger.info(f"📈 Đã hoàn thành {completed}/{len(tasks)} nhận xét... Service Account: {stats}")
                     
-            except Exception as e:
-                index, task_args = future_to_data[future]
-                student_name = task_args[0]
-                failed += 1
-                logger.error(f"❌ Lỗi khi xử lý nhận xét cho {student_name}: {str(e)}")
+                except Exception as e:
+                    failed += len(members)
+                    logger.error(f"❌ Lỗi khi xử lý nhận xét cho {members[0][1][0]}: {str(e)}")
                 
-                # Fallback comment cho lỗi
-                fallback_comment = f"{student_name} đạt điểm tốt trong bài kiểm tra. Tiếp tục cố gắng để đạt kết quả tốt hơn."
-                new_df.at[index, "Nhận xét"] = fallback_comment
+                    # Fallback comment cho lỗi
+                    for index, task_args in members:
+                        new_df.at[index, "Nhận xét"] = error_fallback_comment(task_args[0])
 
     # Thống kê cuối
     final_stats = sa_processor.get_stats()
@@ -0,0 +1,173 @@
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from logger_config import logger
+from data_processor_module4 import handle_sheet
+from service_account_processor import (
+    sa_processor,
+    collect_feedback_tasks,
+    generate_feedback_service_account,
+    get_feedback_process_count,
+    error_fallback_comment,
+)
+from feedback_journal import feedback_journal
+from rate_limiter import get_rate_limiter, init_worker_rate_limiter
+from batch_feedback import FEEDBACK_BATCH_SIZE, chunk_tasks, generate_feedback_batch
+
+
+def process_sheets_parallel(sheets1, sheets2, sheet_names, on_sheet_done=None, resume=False, batch_size=FEEDBACK_BATCH_SIZE):
+    """
+    Chấm điểm các sheet song song trên process pool, rồi đẩy học sinh của mỗi sheet
+    vào một hàng đợi nhận xét chung (một pool Service Account cho tất cả sheet)
+
+    Args:
+        sheets1 (dict): {tên sheet: DataFrame kết quả làm bài}
+        sheets2 (dict): {tên sheet: DataFrame ma trận kiến thức}
+        sheet_names (list): Danh sách sheet cần xử lý (theo thứ tự xuất kết quả)
+        on_sheet_done (callable, optional): Gọi on_sheet_done(sheet_name, df) ngay khi một sheet
+            chấm điểm và nhận xét xong. Khi có callback, sheet được giải phóng khỏi bộ nhớ sau khi gọi
+        resume (bool): Bỏ qua các học sinh đã có nhận xét trong nhật ký (chạy tiếp lần chạy bị dừng)
+        batch_size (int): Số học sinh tối đa trong một request Gemini (1 = mỗi học sinh một request).
+            Học sinh không có trong phản hồi batch được thử lại riêng
+
+    Returns:
+        dict: Kết quả theo từng sheet xử lý thành công ({tên sheet: số học sinh} nếu có on_sheet_done)
+    """
+    result_dfs = {}
+    pending_feedbacks = {}
+
+    def finish_sheet(sheet_name):
+        if on_sheet_done is not None:
+            on_sheet_done(sheet_name, result_dfs[sheet_name])
+            result_dfs[sheet_name] = len(result_dfs[sheet_name])
+
+    jobs = []
+    for sheet_name in sheet_names:
+        if sheet_name not in sheets1 or sheet_name not in sheets2:
+            logger.error(f"❌ Lỗi xử lý sheet {sheet_name}: không tìm thấy sheet trong file kết quả hoặc ma trận")
+            continue
+        jobs.append(sheet_name)
+
+    if not jobs:
+        return result_dfs
+
+    use_feedback = sa_processor.service_account_creds is not None
+    if not use_feedback:
+        logger.error("❌ Không có Service Account credentials!")
+
+    grading_workers = max(1, min(len(jobs), mp.cpu_count() // 2))
+    feedback_workers = get_feedback_process_count()
+    logger.info(f"🔧 Chấm điểm {len(jobs)} sheet với {grading_workers} tiến trình, tạo nhận xét với {feedback_workers} tiến trình Service Account dùng chung")
+
+    feedback_futures = {}
+    start_time = time.time()
+    stats = {"completed": 0, "failed": 0}
+
+    def submit_student(sheet_name, index, task_args):
+        future = feedback_executor.submit(generate_feedback_service_account, task_args)
+        feedback_futures[future] = ("student", sheet_name, (index, task_args))
+
+    def submit_batch(sheet_name, batch):
+        future = feedback_executor.submit(generate_feedback_batch, batch)
+        feedback_futures[future] = ("batch", sheet_name, batch)
+
+    def apply_feedback(sheet_name, index, task_args, feedback, is_fallback):
+        result_dfs[sheet_name].at[index, "Nhận xét"] = feedback
+        if not is_fallback:
+            feedback_journal.record(sheet_name, index, task_args, feedback)
+
+        pending_feedbacks[sheet_name] -= 1
+        if pending_feedbacks[sheet_name] == 0:
+            finish_sheet(sheet_name)
+
+    with ProcessPoolExecutor(max_workers=grading_workers) as grading_executor, \
+            ProcessPoolExecutor(max_workers=feedback_workers, initializer=init_worker_rate_limiter,
+                                initargs=(get_rate_limiter(),)) as feedback_executor:
+        grading_futures = {
+            grading_executor.submit(handle_sheet, sheets1[sheet_name], sheets2[sheet_name]): sheet_name
+            for sheet_name in jobs
+        }
+
+        # Sheet nào chấm xong trước thì đưa học sinh vào hàng đợi nhận xét trước
+        for future in as_completed(grading_futures):
+            sheet_name = grading_futures[future]
+            try:
+                result = future.result()
+            except Exception as sheet_error:
+                logger.error(f"❌ Lỗi xử lý sheet {sheet_name}: {sheet_error}")
+                # Tiếp tục với sheet khác thay vì dừng hoàn toàn
+                continue
+
+            logger.info(f"📊 Sheet {sheet_name}: đã chấm {len(result)} học sinh")
+            result_dfs[sheet_name] = result
+
+            if not use_feedback:
+                finish_sheet(sheet_name)
+                continue
+
+            if "Nhận xét" not in result.columns:
+                result["Nhận xét"] = ""
+
+            tasks = collect_feedback_tasks(result)
+            if resume:
+                tasks, saved_comments = feedback_journal.split_completed(sheet_name, tasks)
+                for index, comment in saved_comments.items():
+                    result.at[index, "Nhận xét"] = comment
+
+            if batch_size > 1:
+                batches = chunk_tasks(tasks, batch_size)
+                for batch in batches:
+                    submit_batch(sheet_name, batch)
+                logger.info(f"🏢 Sheet {sheet_name}: đưa {len(tasks)} học sinh ({len(batches)} batch) vào hàng đợi nhận xét")
+            else:
+                for index, task_args in tasks:
+                    submit_student(sheet_name, index, task_args)
+                logger.info(f"🏢 Sheet {sheet_name}: đưa {len(tasks)} học sinh vào hàng đợi nhận xét")
+
+            pending_feedbacks[sheet_name] = len(tasks)
+            if not tasks:
+                finish_sheet(sheet_name)
+
+        pending = set(feedback_futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, sheet_name, payload = feedback_futures.pop(future)
+
+                if kind == "batch":
+                    try:
+                        comments = future.result()
+                    except Exception as e:
+                        logger.error(f"❌ Lỗi khi xử lý batch {len(payload)} học sinh (sheet {sheet_name}): {str(e)}")
+                        comments = {}
+
+                    for index, task_args in payload:
+                        if index in comments:
+                            apply_feedback(sheet_name, index, task_args, comments[index], False)
+                            stats["completed"] += 1
+                        else:
+                            # Học sinh thiếu trong phản hồi batch: thử lại riêng
+                            submit_student(sheet_name, index, task_args)
+                    continue
+
+                index, task_args = payload
+                try:
+                    student_name, feedback, is_fallback = future.result()
+                    apply_feedback(sheet_name, index, task_args, feedback, is_fallback)
+                    stats["completed"] += 1
+
+                    if stats["completed"] % 5 == 0:
+                        logger.info(f"📈 Đã hoàn thành {stats['completed']} nhận xét... Service Account: {sa_processor.get_stats()}")
+
+                except Exception as e:
+                    student_name = task_args[0]
+                    stats["failed"] += 1
+                    logger.error(f"❌ Lỗi khi xử lý nhận xét cho {student_name} (sheet {sheet_name}): {str(e)}")
+                    apply_feedback(sheet_name, index, task_args, error_fallback_comment(student_name), True)
+
+            # Gồm cả các học sinh vừa được gửi lại riêng
+            pending = set(feedback_futures)
+
+    logger.info(f"🎯 Hoàn thành {len(result_dfs)}/{len(sheet_names)} sheet trong {time.time() - start_time:.1f}s: {stats['completed']} nhận xét thành công, {stats['failed']} thất bại")
+
+    return {sheet_name: result_dfs[sheet_name] for sheet_name in sheet_names if sheet_name in result_dfs}
@@ -1,8 +1,18 @@
 import os
+import hashlib
+from functools import lru_cache
+from dotenv import load_dotenv
 from logger_config import logger
 
+load_dotenv()
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROMPT_FILE = os.path.join(BASE_DIR, "prompt_template.txt")
+BATCH_PROMPT_FILE = os.path.join(BASE_DIR, "prompt_template_batch.txt")
+
+GEMINI_MODEL = "gemini-2.0-flash"
+# Endpoint Gemini thay thế (vd. server giả lập http://127.0.0.1:8765), để trống thì dùng API thật
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "").strip()
 
 def load_prompt(file_path=PROMPT_FILE, **kwargs):
     try:
@@ -12,3 +22,31 @@ def load_prompt(file_path=PROMPT_FILE, **kwargs):
     except Exception as e:
         logger.error(f"Lỗi khi đọc file prompt ({file_path}): {e}")
         return "Không thể đọc prompt."
+
+@lru_cache(maxsize=None)
+def prompt_template_version(file_path=PROMPT_FILE):
+    """Phiên bản template prompt (hash nội dung file), đổi template thì cache phản hồi cũ không còn dùng"""
+    try:
+        with open(file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return "missing"
+
+def build_feedback_prompt(task_args):
+    """Tạo prompt nhận xét từ task_args của một học sinh"""
+    (student_name, class_name, point, correct, wrong, skip, total_questions, correct_basic, correct_advanced,
+     percent_basic, percent_advanced, improvement_content) = task_args
+
+    return load_prompt(
+        student_name=student_name,
+        point=f"{point}/135",
+        correct=correct,
+        wrong=wrong,
+        skip=skip,
+        total_questions=total_questions,
+        correct_basic=correct_basic,
+        percent_basic=percent_basic,
+        correct_advanced=correct_advanced,
+        percent_advanced=percent_advanced,
+        improvement_content=improvement_content,
+    )
@@ -0,0 +1,273 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+from logger_config import logger
+
+# Thư mục cache dữ liệu đã parse (đổi CACHE_VERSION khi thay đổi cách parse để bỏ cache cũ)
+CACHE_DIR = "data/cache/workbooks"
+CACHE_VERSION = 1
+
+
+def _convert_value(value):
+    """Chuẩn hóa giá trị ô giống pd.read_excel (engine openpyxl)"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+        return value
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+def _sheet_rows(sheet):
+    """Đọc tuần tự các dòng của sheet (read-only), bỏ ô trống cuối dòng và dòng trống cuối sheet"""
+    sheet.reset_dimensions()
+
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(sheet.iter_rows(values_only=True)):
+        converted_row = [_convert_value(value) for value in row]
+        while converted_row and converted_row[-1] == "":
+            converted_row.pop()
+        if converted_row:
+            last_row_with_data = row_number
+        data.append(converted_row)
+
+    data = data[: last_row_with_data + 1]
+
+    if data:
+        max_width = max(len(data_row) for data_row in data)
+        data = [data_row + [""] * (max_width - len(data_row)) for data_row in data]
+
+    return data
+
+
+def _rows_to_dataframe(data):
+    """Tạo DataFrame từ các dòng thô (dòng đầu là header), suy luận kiểu như pd.read_excel"""
+    try:
+        return TextParser(data, header=0, skip_blank_lines=False).read()
+    except EmptyDataError:
+        return pd.DataFrame()
+
+
+def file_content_hash(input_file):
+    """Tính SHA-256 nội dung file (đọc theo từng khối)"""
+    digest = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WorkbookCache:
+    """
+    Cache các sheet đã parse, khóa theo (hash nội dung file, tên sheet):
+    một LRU trong bộ nhớ và bản pickle trên đĩa. Khi nội dung file thay đổi,
+    các entry của phiên bản cũ bị xóa; số entry trên đĩa được giới hạn.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_memory_entries=64, max_disk_entries=256):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, file_hash):
+        return f"v{CACHE_VERSION}_{file_hash}"
+
+    def _sheet_path(self, file_hash, sheet_name):
+        sheet_key = hashlib.sha1(sheet_name.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{self._key(file_hash)}_{sheet_key}.pkl")
+
+    def _manifest_path(self):
+        return os.path.join(self.cache_dir, "manifest.json")
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"sources": {}, "workbooks": {}}
+
+    def _write_manifest(self, manifest):
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self._manifest_path())
+
+    def _remove_workbook(self, key):
+        """Xóa toàn bộ file cache của một phiên bản workbook"""
+        prefix = f"{key}_"
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        for memory_key in [k for k in self.memory if k[0] == key]:
+            del self.memory[memory_key]
+
+    def sheet_names(self, file_hash):
+        """Danh sách sheet của workbook đã cache (None nếu chưa có)"""
+        return self._read_manifest()["workbooks"].get(self._key(file_hash))
+
+    def register(self, input_file, file_hash, sheet_names):
+        """Ghi nhận phiên bản hiện tại của file, xóa cache của phiên bản cũ"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest = self._read_manifest()
+        key = self._key(file_hash)
+        source = os.path.abspath(input_file)
+
+        old_key = manifest["sources"].get(source)
+        if old_key and old_key != key and old_key not in [k for s, k in manifest["sources"].items() if s != source]:
+            logger.info(f"🗑️ {input_file} đã thay đổi, xóa cache cũ")
+            self._remove_workbook(old_key)
+            manifest["workbooks"].pop(old_key, None)
+
+        manifest["sources"][source] = key
+        manifest["workbooks"][key] = list(sheet_names)
+        self._write_manifest(manifest)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """Giới hạn số file cache trên đĩa, xóa các file cũ nhất"""
+        entries = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".pkl")
+        ]
+        if len(entries) <= self.max_disk_entries:
+            return
+
+        entries.sort(key=os.path.getmtime)
+        for path in entries[: len(entries) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, file_hash, sheet_name):
+        """Lấy sheet đã parse từ bộ nhớ hoặc đĩa (None nếu chưa có)"""
+        memory_key = (self._key(file_hash), sheet_name)
+        df = self.memory.get(memory_key)
+        if df is not None:
+            self.memory.move_to_end(memory_key)
+            self.hits += 1
+            return df.copy()
+
+        path = self._sheet_path(file_hash, sheet_name)
+        if os.path.exists(path):
+            try:
+                df = pd.read_pickle(path)
+            except Exception as e:
+                logger.warning(f"⚠️ Cache sheet {sheet_name} bị lỗi, đọc lại từ Excel: {e}")
+                self.misses += 1
+                return None
+            os.utime(path)
+            self._remember(memory_key, df)
+            self.hits += 1
+            return df.copy()
+
+        self.misses += 1
+        return None
+
+    def put(self, file_hash, sheet_name, df):
+        """Lưu sheet đã parse vào bộ nhớ và đĩa"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._sheet_path(file_hash, sheet_name)
+        tmp_path = path + ".tmp"
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        self._remember((self._key(file_hash), sheet_name), df.copy())
+
+    def _remember(self, memory_key, df):
+        self.memory[memory_key] = df
+        self.memory.move_to_end(memory_key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get_stats(self):
+        """Lấy thống kê cache"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_entries': len(self.memory)
+        }
+
+
+# Global workbook cache
+workbook_cache = WorkbookCache()
+
+
+def _parse_workbook(input_file, sheet_names):
+    """Mở file Excel một lần (read-only), trả về (danh sách sheet của file, {tên sheet: DataFrame})"""
+    workbook = load_workbook(input_file, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheets = {}
+        for sheet_name in workbook.sheetnames:
+            if sheet_names is None or sheet_name in sheet_names:
+                sheets[sheet_name] = _rows_to_dataframe(_sheet_rows(workbook[sheet_name]))
+        return list(workbook.sheetnames), sheets
+    finally:
+        workbook.close()
+
+
+def _warn_missing_sheets(input_file, sheet_names, all_sheet_names):
+    if sheet_names is None:
+        return
+    missing = [sheet_name for sheet_name in sheet_names if sheet_name not in all_sheet_names]
+    if missing:
+        logger.warning(f"⚠️ Không tìm thấy sheet {missing} trong {input_file}")
+
+
+def load_workbook_sheets(input_file, sheet_names=None, use_cache=True):
+    """
+    Mở file Excel một lần (read-only) và đọc tuần tự các sheet cần dùng.
+    Sheet đã parse được cache theo hash nội dung file, file không đổi sẽ không phải parse lại.
+
+    Args:
+        input_file (str): Đường dẫn file Excel
+        sheet_names (list, optional): Danh sách sheet cần đọc. Nếu None thì đọc tất cả
+        use_cache (bool): Dùng cache dữ liệu đã parse
+
+    Returns:
+        dict: {tên sheet: DataFrame}, theo thứ tự sheet trong file.
+              Sheet không tồn tại trong file sẽ bị bỏ qua
+    """
+    file_hash = file_content_hash(input_file) if use_cache else None
+    all_sheet_names = workbook_cache.sheet_names(file_hash) if use_cache else None
+
+    if all_sheet_names is not None:
+        sheets = {}
+        for sheet_name in all_sheet_names:
+            if sheet_names is None or sheet_name in sheet_names:
+                df = workbook_cache.get(file_hash, sheet_name)
+                if df is None:
+                    break
+                sheets[sheet_name] = df
+        else:
+            logger.info(f"⚡ Đọc {len(sheets)} sheet từ cache cho {input_file}")
+            _warn_missing_sheets(input_file, sheet_names, all_sheet_names)
+            return sheets
+
+    all_sheet_names, sheets = _parse_workbook(input_file, sheet_names)
+
+    if use_cache:
+        workbook_cache.register(input_file, file_hash, all_sheet_names)
+        for sheet_name, df in sheets.items():
+            workbook_cache.put(file_hash, sheet_name, df)
+
+    logger.info(f"📂 Đã đọc {len(sheets)} sheet từ {input_file}")
+    _warn_missing_sheets(input_file, sheet_names, all_sheet_names)
+    return sheets
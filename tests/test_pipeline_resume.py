@@ -0,0 +1,121 @@
+"""
+Chạy pipeline với resume=True và nhiều thread nhận xét trên server Gemini giả lập:
+nhật ký nhận xét được ghi từ các thread của stage nhận xét và lần chạy sau dùng lại được.
+"""
+import os
+import sys
+import socket
+import sqlite3
+import subprocess
+import time
+import random
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def fake_gemini():
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, "fake_gemini_server.py"), "--port", str(port), "--latency", "fixed:0.02"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    yield f"http://127.0.0.1:{port}"
+    server.terminate()
+    server.wait()
+
+
+@pytest.fixture
+def pipeline(fake_gemini, tmp_path, monkeypatch):
+    # Cấu hình phải có trước khi import các module đọc biến môi trường lúc import
+    monkeypatch.setenv("GEMINI_API_ENDPOINT", fake_gemini)
+    monkeypatch.setenv("API_KEY_1", "test-key")
+    monkeypatch.setenv("SERVICE_ACCOUNT_RPM", "60000")
+    monkeypatch.setenv("PIPELINE_PDF_WORKERS", "2")
+    monkeypatch.syspath_prepend(SRC_DIR)
+    monkeypatch.chdir(tmp_path)
+
+    import pipeline
+    from response_cache import response_cache
+    from feedback_journal import feedback_journal
+
+    monkeypatch.setattr(response_cache, "path", str(tmp_path / "response_cache.sqlite3"))
+    monkeypatch.setattr(response_cache, "conn", None)
+    monkeypatch.setattr(feedback_journal, "path", str(tmp_path / "feedback_journal.sqlite3"))
+    monkeypatch.setattr(pipeline, "get_feedback_process_count", lambda total_tasks=None: 3)
+    yield pipeline
+    feedback_journal.close()
+
+
+def make_sheet(n_students, n_questions, seed):
+    import pandas as pd
+
+    rng = random.Random(seed)
+    columns = ["STT", "Họ và tên", "Lớp", "Trường", "Mã trường", "Điểm"] + [f"Info{i}" for i in range(12)]
+    for question in range(1, n_questions + 1):
+        columns += [f"Câu {question}", f"KQ {question}"]
+
+    rows = []
+    for student in range(n_students):
+        row = [student + 1, f"HS {student}", f"{rng.randint(6, 9)}A{rng.randint(1, 3)}", "THCS X", "M1",
+               rng.randint(0, 135)] + [0] * 12
+        for _ in range(n_questions):
+            row += [rng.choice("ABCD"), rng.choice(["Đúng", "Sai", "Bỏ qua"])]
+        rows.append(row)
+
+    matrix = pd.DataFrame([
+        {"Câu hỏi": question, "Cấp độ nhận thức": rng.choice(["NB", "TH", "VD", "VDC"]),
+         "Chủ đề": f"T{question % 3}", "Chương": f"C{question % 2}", "Bài": f"B{question % 4}",
+         "Link bài luyện": "https://example.com", "Môn": "Toán"}
+        for question in range(1, n_questions + 1)
+    ])
+    return pd.DataFrame(rows, columns=columns), matrix
+
+
+def run(pipeline):
+    sheets1, sheets2 = {}, {}
+    for seed, (sheet_name, n_students) in enumerate([("S1", 12), ("S2", 9)]):
+        sheets1[sheet_name], sheets2[sheet_name] = make_sheet(n_students, 10, seed)
+
+    done = {}
+    result = pipeline.run_pipeline(sheets1, sheets2, ["S1", "S2"], "pdfs",
+                                   on_sheet_done=lambda sheet_name, df: done.__setitem__(sheet_name, df), resume=True)
+    return result, done
+
+
+def journal_rows(path):
+    with sqlite3.connect(path) as conn:
+        return dict(conn.execute("SELECT sheet, COUNT(*) FROM feedback GROUP BY sheet").fetchall())
+
+
+def test_resume_with_multiple_feedback_threads(pipeline, tmp_path):
+    from feedback_journal import feedback_journal
+
+    result, done = run(pipeline)
+    assert result == {"S1": 12, "S2": 9}
+    assert set(done) == {"S1", "S2"}
+    for df in done.values():
+        assert df["Nhận xét"].astype(str).str.strip().ne("").all()
+    assert journal_rows(feedback_journal.path) == {"S1": 12, "S2": 9}
+
+    # Lần chạy thứ hai lấy toàn bộ nhận xét từ nhật ký, không gọi lại Gemini
+    first_comments = {sheet_name: df["Nhận xét"].tolist() for sheet_name, df in done.items()}
+    feedback_journal.close()
+    result, done = run(pipeline)
+    assert result == {"S1": 12, "S2": 9}
+    assert {sheet_name: df["Nhận xét"].tolist() for sheet_name, df in done.items()} == first_comments
@@ -0,0 +1,27 @@
+"""
+Stress test backoff theo retry hint trên server Gemini giả lập trả lỗi 429 theo quota (src/retry_benchmark.py):
+so với sleep cố định, ít lượt thử bị lãng phí hơn và không chậm hơn.
+"""
+import os
+import sys
+import json
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def test_retry_hint_backoff_wastes_fewer_attempts(tmp_path):
+    env = dict(os.environ, SERVICE_ACCOUNT_RPM="60000")
+    env.pop("GEMINI_API_ENDPOINT", None)
+    completed = subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, "retry_benchmark.py"),
+         "--tasks", "30", "--workers", "4", "--rpm", "10", "--quota-window", "2"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120,
+    )
+    assert completed.returncode == 0, completed.stderr[-2000:]
+    results = {result["strategy"]: result for result in json.loads(completed.stdout.strip().splitlines()[-1])}
+    hint, fixed = results["retry_hint"], results["fixed_sleep"]
+
+    assert hint["fallbacks"] == 0 and fixed["fallbacks"] == 0
+    assert hint["rate_limited"] * 2 < fixed["rate_limited"]
+    assert hint["seconds"] <= fixed["seconds"] * 1.1